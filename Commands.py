@@ -1,6 +1,7 @@
 #A nice interface for Commands.
 #A command should be passed an unadultered message and return a "Command" object that has nice functions to act on message data
 
+from functools import lru_cache
 import re
 import random
 
@@ -69,6 +70,7 @@ class CommandBuilder():
     
     #List of strings that will trigger commands
     self.triggerStrings = ['botsly', 'bot']
+    self.triggerPattern = makeTriggerPattern(self.triggerStrings)
     
   #This is called during __init__, but can also be called whenever the text changes
   def buildCommands(self, message):
@@ -78,7 +80,7 @@ class CommandBuilder():
     #You can have several commands per message, so like
     # "@botsly addresses @botsly my address is whatever" would just execute two separate commands
     # each element is a two-list consisting of "name match" (bot, botsly, etc.) and the "command" (rest of string)
-    commands = self.recurseFindCommand(message.text)
+    commands = self.findCommands(message.text)
     toRet = []
     #All the commands will be initialized here
     for i in commands:
@@ -86,34 +88,26 @@ class CommandBuilder():
       toRet.append(Command(self.group, i[1], i[0], self.group.users.getUserFromID(message.user_id)))
     return toRet
     
-  #Recursively searches the string for trigger matches. Will start on right and work left, adding commands as it goes.
-  #In the end, returns a list of two-lists of the form "name match" and "command"
-  def recurseFindCommand(self, string, commandList = None):
-    log.command.low("Entering recurse for",string)
-    if not commandList: commandList = list() #Apparently, when you put a list as default argument, it's only evaluated once so the list was holding between calls
-    matchFound = False
-    highestIndex = None
-    #However, we need to ensure that we have the command at the closest to the start of the string possible, so it can be recursed
-    for trigger in sorted(self.triggerStrings, key = len, reverse = True):
-      #log.debug("Testing",trigger)
-      index = string.lower().rfind("@"+trigger)
-      #log.debug("Match at ",index)
-      if index >= 0 and (highestIndex is None or index > highestIndex):
-        #log.debug("Index was","not set" if highestIndex is None else "higher")
-        highestIndex = index
-        matchFound   = True
-        beforeString = string[:index].rstrip() #Remove space between previous and command
-        nameMatch    = string[index:index+len(trigger)+1].lstrip("@")
-        afterString  = string[index+len(trigger)+1:].strip() #Remove space between command, and any at end.
-    if matchFound:
-      commandList.append([nameMatch, afterString])
-      return self.recurseFindCommand(beforeString, commandList)
-      
-    #If no more matches we can return the list of commands
-    #reverse the list so they are in position order
-    commandList.reverse()
+  #Finds every trigger in the string, and splits the string into the commands after each one
+  #POST: Returns a list of two-lists of the form "name match" and "command", in position order
+  def findCommands(self, string):
+    if not string or "@" not in string: #Almost every message isn't talking to us, so don't bother searching
+      return []
+    matches = list(self.triggerPattern.finditer(string))
+    if not matches:
+      return []
+    log.command.low("Finding commands in",string)
+    commandList = []
+    for match, nextMatch in zip(matches, matches[1:] + [None]):
+      #The command is everything until the next trigger
+      commandList.append([match.group(1), string[match.end():nextMatch.start() if nextMatch else len(string)].strip()])
     return commandList
    
+#POST: Returns a pattern that finds "@trigger" for any of the triggers (ignoring case), with the trigger as group 1
+#      Longer triggers are tried first, so "@botsly" isn't found as "@bot"
+def makeTriggerPattern(triggerStrings):
+  return re.compile("@(" + "|".join(re.escape(trigger) for trigger in sorted(triggerStrings, key = len, reverse = True)) + ")", re.I)
+   
 def methodize(toGet): #I swear I'm not a protestant
   return toGet.replace(" ","_")
    
@@ -126,19 +120,46 @@ def filterWords(string, wordList, replacement = ""):
 def stripPunctuation(string):
   return string.strip(".!?,:;'\"()")
   
+#Words are looked for many times with the same patterns, so each pattern is only compiled once
+@lru_cache(maxsize = 256)
+def getWordPattern(word):
+  return re.compile(r"\b"+word+r"\b", re.I)
+  
 def findWord(word, string):
   if type(word) == str:
     word = [word]
   if not word: return None
   for i in word:
-    match = re.search(r"\b"+i+r"\b", string, re.I)
+    match = getWordPattern(i).search(string)
     if match: return match
   
+ME_PATTERN = re.compile(r"\b(?:me|my|I)\b", re.I)
 def findMe(string):
-  for word in ["me","my","I"]:
-    match = findWord(word, string)
-    if match:
-      return match #If not found will return None
+  return ME_PATTERN.search(string) #If not found will return None
+  
+### Command Table ###
+#Dict of pattern : command name (or None if the pattern is the command name). Commands earlier in the table are found first
+COMMANDS = {name: None for name in [\
+            "version", "help", "address", "addresses", "joke", "name", "names", "human affection", "happy birthday", "group password", "shutdown", "restart", \
+            "id", "baddresses"]}
+#Example: {"residence":"address"}
+COMMANDS.update({"website":"help", "jokes":"joke", r"facts?":"joke", r"pics?":"joke", "pictures?":"joke",
+                 "called":"name", "love":"human affection"})
+COMMAND_LIST = list(COMMANDS) #So the group number of a match gives the pattern
+
+#One pattern that finds every command. Each command is a named group, in the same order as the table
+#The lookahead lets matches overlap, so a command can be found inside the words of another one
+COMMAND_PATTERN = re.compile(r"(?=\b(?:" + "|".join("(?P<command{}>{})".format(i, pattern) for i, pattern in enumerate(COMMAND_LIST)) + r")\b)", re.I)
+
+#POST: Returns the match for the command earliest in the table that is in string (its earliest place in the string), or None
+#      The match's group "lastindex" is the command's pattern
+def findCommand(string):
+  best = None
+  for match in COMMAND_PATTERN.finditer(string):
+    if best is None or match.lastindex < best.lastindex:
+      best = match
+      if best.lastindex == 1: break #Can't find an earlier command
+  return best
    
 ### Command Class ###
 #In addition to message functions, this module will contain functions to respond to commands (and manipulate data that could be used in them)
@@ -155,6 +176,10 @@ Each "command" will have 3 definitions.
 1. A string in the dict (plus other commands that could match)
 2. A do_command function that sets all parameters and returns nothing
 3. A handle_command function that will act on data, returning a string or None and possibly posting to the parent group
+Commands that can take a long time (like getting things from the internet) can also have
+4. A slow_command function that returns True if handling this command will be slow.
+   Slow commands can have a fetch_command function that gets whatever they need from the internet on a worker thread, storing it in .fetched
+   It must not change any shared state. handle_command is then run under the message lock, and its text is posted on its own when done
 """
 class Command():
 
@@ -163,12 +188,7 @@ class Command():
     if not isinstance(group, Groups.Group):
       raise TypeError(type(self).__name__ + " object expected a Groups.Group object, got " + str(type(group)))
       
-    self.commands = {name: None for name in [\
-                     "version", "help", "address", "addresses", "joke", "name", "names", "human affection", "happy birthday", "group password", "shutdown", "restart", \
-                     "id", "baddresses"]}
-    #Example: {"residence":"address"}
-    self.commands.update({"website":"help", "jokes":"joke", r"facts?":"joke", r"pics?":"joke", "pictures?":"joke",
-                          "called":"name", "love":"human affection"})
+    self.commands = COMMANDS
     
     #May or may not be set
     self.sender = None
@@ -183,6 +203,7 @@ class Command():
     self.leftString   = None
     self.rightString  = None
     self.wholeString  = None #Left + " " + Right
+    self.fetched      = None #Set by fetch_command for slow commands, off of the message lock
     
     #Always have these
     self.group = group
@@ -193,25 +214,24 @@ class Command():
       self.sender = sender.getGMName()
     
     log.command.low("Command String:",self.message)
-    for command in self.commands:
-      log.command.low("Looking for command:", command)
-      match = findWord(command, self.message)
-      if match:
-        methodName = "do_"+methodize(self.commands[command] or command)
-        self.leftString  = self.message[:match.start()].rstrip()
-        self.rightString = self.message[match.end():].lstrip()
-        self.wholeString  = self.leftString + " " + self.rightString
-        log.command.low("Left:",self.leftString)
-        log.command.low("Right:",self.rightString)
-        try:
-          method = getattr(self, methodName)
-          log.command.debug("Starting method", methodName)
-        except AttributeError:
-          log.command.error("No Command handling method found for",command)
-        method()
-        self.command = self.commands[command] or command
-        log.command.low("Results of command:", self.formatSelf())
-        break
+    match = findCommand(self.message)
+    if match:
+      command = COMMAND_LIST[match.lastindex-1]
+      log.command.low("Found command:", command)
+      methodName = "do_"+methodize(self.commands[command] or command)
+      self.leftString  = self.message[:match.start(match.lastindex)].rstrip()
+      self.rightString = self.message[match.end(match.lastindex):].lstrip()
+      self.wholeString  = self.leftString + " " + self.rightString
+      log.command.low("Left:",self.leftString)
+      log.command.low("Right:",self.rightString)
+      try:
+        method = getattr(self, methodName)
+        log.command.debug("Starting method", methodName)
+      except AttributeError:
+        log.command.error("No Command handling method found for",command)
+      method()
+      self.command = self.commands[command] or command
+      log.command.low("Results of command:", self.formatSelf())
     
   def formatSelf(self):
     return "<Command.Command object with \n" + "\n".join([name+": "+repr(getattr(self,name)) for name in ['verb','recipient','recipientObj','specifier','command','details']])+">"
@@ -224,7 +244,26 @@ class Command():
       
     self.recipient = fromString.strip()
     self.recipientObj = self.group.users.getUser(fromString.lstrip("@")) if self.recipient else self.senderObj #So it defaults to the senderObj if you do like "address" it should return your address
-    if not self.recipientObj: self.recipientObj = self.senderObj #It will also default to senderObj if we can't find any user (POTENTIALLY BAD)
+    if not self.recipientObj: #Then try for a name that is close, in case of typos
+      self.recipientObj = self.group.users.getUserFuzzy(self.recipient)
+    if not self.recipientObj:
+      log.command("Could not find recipient", '"'+self.recipient+'"', "using sender instead")
+      self.recipientObj = self.senderObj #It will also default to senderObj if we can't find any user (POTENTIALLY BAD)
+    
+  #POST: Returns True if the command should be handled on a worker thread
+  def isSlow(self):
+    if self.command:
+      method = getattr(self, "slow_"+methodize(self.command), None)
+      if method:
+        return bool(method())
+    return False
+    
+  #Gets things for a slow command from the internet. Called on a worker thread without the message lock
+  def fetch(self):
+    if self.command:
+      method = getattr(self, "fetch_"+methodize(self.command), None)
+      if method:
+        method()
     
   def handle(self):
     if self.command:
@@ -391,24 +430,34 @@ class Command():
       self.verb = "unsubscribe"
       self.setRecipient(self.leftString)
      
+  def slow_joke(command): #Jokes come from the internet, but joke types and subscriptions don't
+    return command.verb == "get" and command.specifier != "type"
+    
+  def numJokes_joke(command):
+    if command.specifier == "some":
+      return random.randint(2,5) #Between 2 and 4
+    elif type(command.specifier) == int:
+      return min(max(1, command.specifier), 7) #Between 1 and 7
+    return 1
+    
+  def fetch_joke(command): #Only gets the jokes' internet data, the jokes themselves are chosen in handle_joke
+    arg = (command.details,) if command.jokeHandler == Jokes.joke else ()
+    command.fetched = [command.jokeHandler.fetchJoke(*arg) for i in range(command.numJokes_joke())]
+    
   def handle_joke(command):
     if command.verb == "get":
       if command.specifier == "type":
         return "Joke Types: " + " | ".join((joke + "s") for joke in Jokes.BaseJoke._jokeObjects if joke != "regular") #Join all the joke types in the dictionary
       else:
         toRet = ""
-        numJokes = 1
-        if command.specifier == "some":
-          numJokes = random.randint(2,5) #Between 2 and 4
-        elif type(command.specifier) == int:
-          numJokes = min(max(1, command.specifier), 7) #Between 1 and 7
+        fetchedList = command.fetched or [None] * command.numJokes_joke()
           
         if command.jokeHandler == Jokes.joke:
-          for i in range(numJokes):
-            toRet += Jokes.joke.getJoke(command.details) + "\n" #Add a joke to the buffer since it is just text. The details is possible category
+          for fetched in fetchedList:
+            toRet += Jokes.joke.getJoke(command.details, fetched = fetched) + "\n" #Add a joke to the buffer since it is just text. The details is possible category
         else:
-          for i in range(numJokes):
-            command.jokeHandler.postJoke(command.group) #Otherwise just post the jokes by themselves
+          for fetched in fetchedList:
+            command.jokeHandler.postJoke(command.group, fetched = fetched) #Otherwise just post the jokes by themselves
             
         return toRet
     elif command.verb == "subscribe":
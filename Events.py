@@ -1,10 +1,13 @@
 #Interface for lock objects and timers
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, time, timedelta
 import os
 import threading
+import traceback
 
 import Logging as log
+import Metrics
 
 ### CROSS-MODULE CONSTANTS ###
 IS_TESTING = os.path.basename(os.getcwd()) in ["test","dev"]
@@ -47,6 +50,41 @@ def stopAllTimers():
     thread.cancel()
     
     
+#Worker threads for slow things (like getting jokes from the internet) so they don't hold the lock while messages wait
+WORKER_THREADS = 4
+_workerPool = None
+_workerPoolLock = threading.Lock()
+WORKER_JOBS = Metrics.gauge("worker_jobs", "Background jobs waiting or running")
+
+def getWorkerPool():
+  global _workerPool
+  with _workerPoolLock:
+    if not _workerPool:
+      log.event("Starting worker pool with", WORKER_THREADS, "threads")
+      _workerPool = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix = "Worker")
+    return _workerPool
+    
+#Runs the function on a worker thread. The function does NOT have the lock, so it should only touch things that are safe without it
+#POST: Returns the Future for the job
+def runInBackground(function, *arg, **kwarg):
+  def job():
+    try:
+      return function(*arg, **kwarg)
+    except Exception:
+      log.error("Error in background job", function.__name__)
+      log.error(traceback.format_exc())
+    finally:
+      WORKER_JOBS.dec()
+  WORKER_JOBS.inc()
+  return getWorkerPool().submit(job)
+  
+def shutdownWorkerPool():
+  global _workerPool
+  with _workerPoolLock:
+    if _workerPool:
+      _workerPool.shutdown(wait = False, cancel_futures = True)
+      _workerPool = None
+    
 #These are for saving all groups who have added messages at once (not during message processing so responses are fast always)
 _SyncSave_ = None #This is the actual object
 def SyncSave():
@@ -55,10 +93,13 @@ def SyncSave():
     _SyncSave_ = _SyncSave()
   return _SyncSave_ #Return the object we have
 
+SYNC_SAVE_TIME = Metrics.histogram("sync_save_seconds", "Time taken to save all waiting objects")
+SYNC_SAVE_WAITING = Metrics.gauge("sync_save_waiting", "Objects waiting to be saved", function = lambda: len(_SyncSave_._objects) if _SyncSave_ else 0)
+
 class _SyncSave:
   def __init__(self, interval = 60):
     self.interval = interval #Interval between saves in seconds
-    self._objects = [] #The list of all object we have
+    self._objects = {} #Dict of object : function to save it (or None to call object._save), in the order they were added
     
     self.timer = None
     #Start a timer that runs every so many seconds
@@ -75,18 +116,25 @@ class _SyncSave:
     registerThread(self.timer)
     self.timer.start()
   
-  def addObject(self, object):
+  #Adds an object to be saved on the next interval. Adding an object that is already waiting does nothing, so it is only saved once
+  #PRE : function is called with no arguments to save the object. If None, object._save() is called
+  def addObject(self, object, function = None):
     if object in self._objects:
       return None #Don't worry if we already have it
-    self._objects.append(object)
+    self._objects[object] = function
+    
+  #Stops an object from being saved, like if it has been deleted
+  def removeObject(self, object):
+    self._objects.pop(object, None)
     
   def saveAll(self, final = False):
     try:
       if len(self._objects): # if != 0
         log.event("Saving all messages for",len(self._objects),"group"+("s" if len(self._objects) > 1 else ""))
-        while len(self._objects): #While there are still objects in the list
-          object = self._objects.pop() #Take it off and use it
-          object._save() #_save must be a function that DOES NOT CALL addObject
+        with SYNC_SAVE_TIME.time():
+          while len(self._objects): #While there are still objects in the list
+            object, function = self._objects.popitem() #Take it off and use it
+            (function or object._save)() #_save must be a function that DOES NOT CALL addObject
     finally: #Whether or not we are successful, add another timer
       if not final:
         self.resetTimer()
@@ -3,6 +3,7 @@
 
 import json
 import os
+import re
 import shutil
 
 import Logging as log
@@ -47,6 +48,33 @@ def deleteFile(file):
 
 #### Utilities ####
 
+#Keeps track of the newest numbered file for each log, so finding it doesn't need to check the disk
+#The folder is only looked through once, then LogAccessor tells the index whenever it starts a new file
+class LogIndex():
+  LOG_PATTERN = re.compile(re.escape(getFileName("NAME_NUM")).replace("NAME", "(.+)").replace("NUM", r"(\d+)"))
+  
+  def __init__(self):
+    self._newest = None #Dict of logName : newest log number
+    
+  def load(self):
+    self._newest = {}
+    for fileName in os.listdir(os.path.dirname(getFileName("log")) or None):
+      match = self.LOG_PATTERN.fullmatch(fileName)
+      if match:
+        logName, num = match.group(1), int(match.group(2))
+        self._newest[logName] = max(num, self._newest.get(logName, 0))
+        
+  #POST: Returns the number of the newest file of a log, or None if there are none
+  def getNewest(self, logName = "log"):
+    if self._newest is None: self.load()
+    return self._newest.get(logName)
+    
+  def setNewest(self, logName, num):
+    if self._newest is None: self.load()
+    self._newest[logName] = num
+    
+logIndex = LogIndex()
+
 #This gets the specified log file, or most recent log file if None
 #PRE: num should be an integer. If num < 0, will index from the last log file. logName is the name of the log file (it will be appended _num)
 #POST: returns the requested log file. log file may or may not exist depending on number requested. If last log file number - num is < 0, will return log file 0
@@ -54,13 +82,30 @@ def getLog(num = -1, logName = "log"):
   if type(num) == int and num >= 0:
     return getFileName(logName+"_"+str(num))
   
-  #Otherwise we are searching for largest
-  count = 0
-  while count < 1000: #Arbitrary high number
-    curr = getFileName(logName+"_"+str(count))
-    if not os.path.exists(curr): #Returns descriptor to num-1 away from end (-1 will give end, -2 will give second to last)
-     return getFileName(logName+"_"+str(max(count+num,0)))
-    count += 1
+  #Otherwise we are searching from the newest (-1 will give newest, -2 will give second to last)
+  newest = logIndex.getNewest(logName)
+  if newest is None:
+    return getFileName(logName+"_0")
+  return getFileName(logName+"_"+str(max(newest+1+num, 0)))
+  
+#Reads the end of a file without reading the whole thing
+#PRE : numLines is how many lines to get
+#POST: Returns the last numLines lines of the file as bytes
+def tailFile(fileName, numLines, blockSize = 8192):
+  if numLines <= 0:
+    return b""
+  with open(fileName, "rb") as handle:
+    position = handle.seek(0, os.SEEK_END)
+    data = b""
+    #Read blocks backwards until we have one more line break than the lines we need (or the start of the file)
+    #A line break at the very end of the file doesn't count, it just ends the last line
+    while position > 0 and data.count(b"\n", 0, len(data) - 1) < numLines:
+      readSize = min(blockSize, position)
+      position -= readSize
+      handle.seek(position)
+      data = handle.read(readSize) + data
+  lines = data.splitlines(keepends = True)
+  return b"".join(lines[-numLines:])
 
 def getLogHandle(*arg, **kwarg):
   return open(getLog(*arg, **kwarg))
@@ -133,6 +178,25 @@ class SafeOpen:
     
   def __exit__(self, *errors):
     self.file.close()
+    
+#Like SafeOpen for writing, but writes to a temporary file and replaces the real one when done
+#  so a crash part way through writing never leaves a half-written file
+class AtomicOpen:
+  def __init__(self, fileName, mode = "w", **kwarg):
+    createFolder(os.path.dirname(fileName) or ".") #Files in the current folder have no folder name
+    self.fileName = fileName
+    self.tempName = fileName + ".tmp"
+    self.file = open(self.tempName, mode, **kwarg)
+    
+  def __enter__(self):
+    return self.file
+    
+  def __exit__(self, errorType, *errors):
+    self.file.close()
+    if errorType is None:
+      os.replace(self.tempName, self.fileName)
+    else: #Leave the old file as it was
+      deleteFile(self.tempName)
             
 """#Nifty function for displaying KB, MB, GB, etc.            
 def sizeof_fmt(num, suffix='B'):
@@ -146,15 +210,15 @@ class LogAccessor: #Meant to be used like "with LogAccessor(fileName) as file:"
   fileSize = 1 * 1024**2 #Log file size should be no more than 1 MB
   
   def __init__(self, fileName):
-    fileName += "_"
-    lastNum = 0
+    lastNum = logIndex.getNewest(fileName) or 0
     try:
-      while os.path.getsize(getFileName(fileName + str(lastNum))) > self.fileSize: #File should no more than max size
+      if os.path.getsize(getFileName(fileName + "_" + str(lastNum))) > self.fileSize: #File should no more than max size
         lastNum += 1
     except FileNotFoundError:
       pass #Means we should make a new file
+    logIndex.setNewest(fileName, lastNum)
       
-    self.file = open(getFileName(fileName + str(lastNum)), "ab")
+    self.file = open(getFileName(fileName + "_" + str(lastNum)), "ab")
   
   def __enter__(self):
     return self.file
@@ -4,16 +4,19 @@
 #Groups will have access to local information about each "User", and their functions
 
 import dateutil.parser
+import io
 import json
 import pickle
 import random
 import re
+import threading
 import time
 
 import Commands
 import Events
 import Files
 import Jokes
+import LiveFeed
 import Logging as log
 import MsgSearch
 import Network
@@ -29,6 +32,15 @@ groupIDDict = {}
 #The common name for a save file in a group's folder
 SAVE_FILE_NAME = "groupData"
 
+#Goes up every time any group's version does, or a group is added or removed. Lets the website know when pages need to be remade
+_globalVersion = 0
+def getGlobalVersion():
+  return _globalVersion
+  
+def bumpGlobalVersion():
+  global _globalVersion
+  _globalVersion += 1
+
 def getGroup(groupIdent):
   try: #First tries to get internal id
     return groupDict[groupIdent]
@@ -100,6 +112,7 @@ def groupRegister(groupObj, firstID = None):
     
   if groupObj.groupID:
     groupIDDict[groupObj.groupID] = groupObj
+  bumpGlobalVersion()
     
 #This goes through all the registration dictionaries and removes traces of the group
 #PRE: "tables" must be a list of dicts
@@ -112,6 +125,7 @@ def groupDeregister(groupObj , tables = [groupDict, groupIDDict]):
     for i in table.copy():
         if table[i] == groupObj:
           del table[i]
+  bumpGlobalVersion()
 
 
 ### Group List Acquisition Functions ###
@@ -171,6 +185,13 @@ class Group():
     self.commands  = {}
     
     self.markedForDeletion = False #Groups can get deleted. I want to delete the ones that don't exist, just not during initialization
+    self.version = 0 #Goes up whenever the group's name or users change. Not saved
+    self._roster = None #Dict of user ID : nickname from the last time members were loaded from the web
+    self.deleted = False #Set once the group deletes itself, so it is not saved again
+    #Saves are written to file by Events.SyncSave. These are the text that will be or has been written, and whether it needs writing
+    self._savedText = None
+    self._dirty = False
+    self._saveLock = threading.Lock() #Writing happens on the SyncSave thread
     
     groupRegister(self, ID) #If no ID, will assign an id automatically
     
@@ -227,7 +248,12 @@ class Group():
     log.group(type(self),self.ID,"deleting itself")
     log.group("Deregistering self")
     groupDeregister(self)
+    with self._saveLock:
+      self.deleted = True
+    Events.SyncSave().removeObject(self)
     log.group("Deleting Folder")
+    self.users.store.delete() #So no waiting user saves make the folder again
+    self.users.releaseIdentities()
     Files.deleteFolder(Files.getGroupFolder(self))
   
   ### Utility Functions ###
@@ -236,7 +262,23 @@ class Group():
     return self.name if self.name else "Group " + str(self.ID)
     
   def setName(self, name):
-    self.name = name
+    if name != self.name:
+      self.name = name
+      self.bumpVersion()
+      
+  def setImage(self, image):
+    if image != self.image:
+      self.image = image
+      self.bumpVersion()
+      
+  #Should be called whenever anything shown about the group changes (like its name or a user's name)
+  def bumpVersion(self):
+    self.version += 1
+    bumpGlobalVersion()
+    
+  #POST: Returns a number that changes every time the group's data does
+  def getVersion(self):
+    return self.version
     
   def getID(self):
     return self.ID
@@ -303,13 +345,14 @@ class Group():
     #First Record Data
     #Each group will get a "searcher" assigned it that loads all the group's messages and can search through them on command
     MsgSearch.getSearcher(self).appendMessage(message)
+    LiveFeed.publish(self, message) #Anyone watching the group on the website
     
     if message.sender_type == "bot": return #We don't care what bot has to say, only record that it did
     #log.network("Handling message: ", message) #Really want to see this for now while handling stuff
     
     self.buffer = ""
     
-    if message.text.lower() == "bot?": #Classic test
+    if message.text and message.text.lower() == "bot?": #Classic test
       self.buffer += "Yes? \U0001f604"
     
     self._handleMessage(message)
@@ -322,6 +365,11 @@ class Group():
       if not command.message.strip(): #If there isn't actually any text with the command
         continue
         
+      if command.isSlow(): #It will post on its own when it is done, so we don't keep everyone waiting
+        log.command("Handling", command.command, "command in the background")
+        Events.runInBackground(self.handleSlowCommand, command)
+        continue
+        
       commandNum += 1
       if len(commandList) > 1:
         if commandNum > 1: #Add in a newline if on the second or more command
@@ -339,6 +387,15 @@ class Group():
     if message.sender_type == "user": #Only if it is user, not system
       Jokes.postReleventJokes(self.users.getUserFromID(message.user_id), message.text)
     
+  #Handles a command on a worker thread, posting its text when done
+  #Only the fetching happens off the lock, because handling can change jokes, users, and the group
+  def handleSlowCommand(self, command):
+    command.fetch()
+    with Events.getLockObject():
+      text = command.handle()
+      if text and text.strip():
+        self.handler.write(text.rstrip())
+      
   #This is for things specific to a certain type of group. Like handling events for MainGroups
   #NOTE FOR SUBCLASSES: Subclasses should do super() after their own handling
   #This stuff is in the parent class so that subclasses can just "return" and stop this processing from happening
@@ -372,21 +429,28 @@ class Group():
       log.group.error("Group no longer exists. Recommend deleting group",self.ID)
      
     if groupData.code == 200:
-      loadedList = [] #List of objects to check
-      updateList = [] #This is just a list of names
       self.setName(groupData['name']) #Store the name the group has for future reference
-      try: self.image = groupData['image_url'] #Try to get this if it exists (should exist, can't be bothered to check)
+      try: self.setImage(groupData['image_url']) #Try to get this if it exists (should exist, can't be bothered to check)
       except KeyError: pass
-      for user in groupData['members']:
-        #log.group.web("Updating user", '"'+user['nickname']+'"')
-        updateList.append(user['nickname'])
-        userObj = self.users.updateUser(user)
-        loadedList.append(userObj)
-        
-      log.group.web("Users loaded:", ",".join(updateList))
+      
+      members = {member['user_id'] : member for member in groupData['members']}
+      roster = {ID : members[ID]['nickname'] for ID in members}
+      #If nobody joined, left, or changed their name since last time (and we haven't added or removed anyone ourselves), there is nothing to do
+      if roster == self._roster and self.users.IDDict.keys() == roster.keys():
+        log.group.web("Members unchanged for Group", self.ID)
+        return
+      self._roster = roster
+      
+      #Only update the users that are new or have a new nickname
+      current = self.users.IDDict
+      changed = [members[ID] for ID in members if ID not in current or current[ID].GMName != roster[ID]]
+      for member in changed:
+        self.users.updateUser(member)
+      if changed:
+        log.group.web("Users loaded:", ",".join(member['nickname'] for member in changed))
         
-      for userObj in self.users.userList.copy():
-        if userObj not in loadedList:
+      for userObj in self.users.userList:
+        if userObj.ID not in members:
           log.group.web(userObj,"does not exist on web, deleting user data")
           self.removeUser(userObj) #If they don't exist on the web, we shouldn't save their data
 
@@ -397,12 +461,32 @@ class Group():
   
   #This is the save that should be used normally
   #"basic" save should be used only during __init__, to make sure that the group exists so it's type can be read
+  #The group's data is saved to memory now and written to file later by Events.SyncSave, so saving many times only writes once
+  #  If nothing has changed since the last save, nothing is written
   def save(self): #Method for saving a group and its data
-    log.save("Saving:", self)
-    with Files.SafeOpen(self.filePath, "w") as file:
-      file.write(type(self).__name__+"\n")
-      self._save(file)
+    buffer = io.StringIO()
+    buffer.write(type(self).__name__+"\n")
+    self._save(buffer)
+    text = buffer.getvalue()
+    with self._saveLock:
+      if self.deleted or text == self._savedText:
+        return self
+      log.save("Saving:", self)
+      self._savedText = text
+      self._dirty = True
+    Events.SyncSave().addObject(self, self.flush)
     return self
+    
+  #Writes the last save to file. Called by Events.SyncSave
+  def flush(self):
+    with self._saveLock:
+      if self.deleted or not self._dirty:
+        return
+      text = self._savedText
+      self._dirty = False
+    log.save.low("Writing", self, "to file")
+    with Files.AtomicOpen(self.filePath, "w") as file:
+      file.write(text)
 
   def _save(self, writeHandle): #This is where you have class specific saving things.
     Files.saveAttrTable(self, writeHandle, ["groupID", "name", "image", "password", "owner", "bot", "analytics", "commands"])
@@ -668,11 +752,15 @@ class SubGroup(Group):
     
     #Now that all associations have been formed, we can load references
     for user in list(self.users):
-      if isinstance(self, Users.UserMimic):
-        parent = self.parent.users.getUser(user._tempID, idOnly = True)
+      if isinstance(user, Users.UserMimic) and user.getParent() is None:
+        parent = self.parent.users.getUser(user._tempID, onlyID = True)
         if not parent: raise RuntimeError("UserMimic in Group " + str(self.ID) + " could not find parent from ID " + user._tempID)
         user.setParent(parent)
     
+  #Our users' names are mostly our parent's, so our version changes with theirs too
+  def getVersion(self):
+    return self.version + self.parent.getVersion()
+    
   #If parentGroup is not a subgroup, self.parent will be set to it. Otherwise, TypeError is raised
   def setParent(self, parentGroup):
     if isinstance(parentGroup, SubGroup):
@@ -767,7 +855,7 @@ class EventGroup(SubGroup):
         if 'name' in toAdd:
           self.setName(toAdd['name'])
         if 'image' in toAdd:
-          self.image = toAdd['image']
+          self.setImage(toAdd['image'])
     
     
     self.save()
@@ -815,16 +903,12 @@ class CollectorGroup(Group):
   #Given a function that can change the users in a group, call it and calculate changed users
   #All other args are passed to function
   def canChangeUsers(self, function, *arg, **kwarg):
-    before = self.users.userList.copy()
+    before = self.users.snapshot()
     
     function(*arg, **kwarg)
     
-    after = self.users.userList.copy()
-    
-    #Pass the users to add if they didn't exist before
-    toAdd = [user for user in after if user not in before]
-    #Pass the users to remove if they don't exist any more
-    toRemove = [user for user in before if user not in after] 
+    #Pass the users to add if they didn't exist before, and the users to remove if they don't exist any more
+    toAdd, toRemove = Users.UserList.getChanges(before, self.users.snapshot())
     log.group.debug("CollectorGroup Users may have changed")
     log.group.debug("Adding:  ",toAdd)
     log.group.debug("Removing:",toRemove)
@@ -853,12 +937,13 @@ class CollectiveGroup(Group):
     if not users: return #If users is empty, don't do anything
     
     log.group.debug("In addUsers, got", users)
+    #If they are already in the group, don't add them again
+    alreadyAdded = [user for user in users if groupID in self.collectiveUsers.get(user.ID, ())]
+    if alreadyAdded:
+      log.group.debug(alreadyAdded,"already in CollectiveGroup")
+      users = [user for user in users if groupID not in self.collectiveUsers.get(user.ID, ())]
+      if not users: return
     for user in users:
-      #If they are already in the group, don't add them again
-      if user.ID in self.collectiveUsers and groupID in self.collectiveUsers[user.ID]:
-        log.group.debug(user,"is already in CollectiveGroup")
-        users.pop(users.index(user))
-        continue
       if not user.ID in self.collectiveUsers:
         self.collectiveUsers[user.ID] = set() #New set
       self.collectiveUsers[user.ID].add(groupID) #Add this group to the list they've been added from
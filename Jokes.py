@@ -1,7 +1,7 @@
 #This file handles all the jokes and bat facts and other misceallaneous stuff that goes on in the server.
 
 import xml.etree.ElementTree as xml
-import copy, json, random, html.parser, re
+import copy, json, random, html.parser, re, socket
 
 import Events
 import Files
@@ -45,9 +45,15 @@ class BaseJoke():
   def acquireJokes(self):
     pass
     
+  #A function to get anything getJoke will need from the internet. It is run on a worker thread without the message lock, so it must not change any joke state
+  #PRE : *arg is the same as would be passed to getJoke
+  #POST: Returns something to give to getJoke as "fetched", or None if nothing was needed
+  def fetchJoke(self, *arg):
+    return None
+    
   #A function that should return the string of a joke
   #Typically used internally
-  #PRE : Should be given a group so can acquire from the internet
+  #PRE : Should be given a group so can acquire from the internet. If a subclass has a fetchJoke, it should take a "fetched" keyword with its result
   #POST: Should return a string. If there is only a joke, should return string. If joke and picture url, should return a 2-tuple of jokeString and urlString. If joke get failed, should return False
   def getJoke(self):
     return ""
@@ -70,10 +76,10 @@ class BaseJoke():
       log.joke.error("GET JOKE DID NOT GET JOKE", "Cannot Post Joke/Fact")
     
   #Posts a joke to the group
-  #PRE : group should be the group to post to, *arg is passed to getJoke
+  #PRE : group should be the group to post to, *arg is passed to getJoke. fetched is the result of fetchJoke, if it was called
   #POST: Returns True if a message was posted to the user's group, False otherwise
-  def postJoke(self, group, *arg):
-    joke = self.getJoke(*arg)
+  def postJoke(self, group, *arg, fetched = None):
+    joke = self.getJoke(*arg) if fetched is None else self.getJoke(*arg, fetched = fetched)
     return self._postJoke(group, joke)
   
   postFact = postJoke #Alias
@@ -131,12 +137,15 @@ class JokeWebsiteParser(html.parser.HTMLParser):
 
 #Standard Joke is the OG internet joke, is a singleton, and this handler existed a LONG time
 class StandardJoke(BaseJoke):
+  TIMEOUT = 10 #Seconds to wait for the joke website
+  
   def __init__(self):
     super().__init__("regular")
     self.categories = ["haha","signs","nerd","professional","quotes","lightbulb","blonde","laws"]
     self.connection = Network.Connection("www.randomjoke.com")
     
-  def getJoke(self, category = ""):
+  #Nothing here touches shared state, so the whole joke can be gotten off the message lock
+  def fetchJoke(self, category = ""):
     log.joke.debug("New Joke, received category",category)
     if category and type(category) != str:
       raise TypeError("getJoke expected a str category, got " + str(type(category)))
@@ -144,10 +153,8 @@ class StandardJoke(BaseJoke):
     category = category.lower()
     if not category in self.categories: category = random.choice(self.categories)
     try:
-      log.network.low("Suppressing network for joke acquisition")
-      log.network.debug.pushState(False) #Super long, super annoying message
-      joke, code = self.connection.get("/topic/"+category+".php")
-      log.network.debug.popState()
+      #Not forcing the log because the page is super long, super annoying message
+      joke, code = self.connection.get("/topic/"+category+".php", timeout = self.TIMEOUT, forceLog = False)
       joker = JokeWebsiteParser()
       #This is for debugging
       #file = open("lastJoke.html","wb")
@@ -156,7 +163,13 @@ class StandardJoke(BaseJoke):
       joker.feed(joke)
       joker.close()
     except (UnicodeDecodeError): joker.joke = "I don't get it D: (The joke website is acting up)"
+    except (socket.timeout, OSError): #ConnectionError is an OSError too
+      log.joke.error("Could not get joke from", self.connection.target)
+      return "I forgot the joke D: (The joke website isn't answering)\n"
     return "A joke from the '"+category.title()+"' category!\n" + (re.sub(r"[\n\r]"," ",joker.joke).strip() if len(joker.joke) < 1000 else "JK the joke is about English Class because its so long and drawn out") + "\n" 
+    
+  def getJoke(self, category = "", fetched = None):
+    return fetched if fetched is not None else self.fetchJoke(category)
 
     
 #Simple jokes simply return jokes stored in a list or tuple
@@ -303,18 +316,23 @@ class InternetFact(SimpleFileJoke, SimpleFact):
     
     self.connection = Network.Connection(urlDomain, https = HTTPS)
       
-  def acquireJokes(self): #Gets new fact(s)
-    XML_Dict = {"_":"http://www.w3.org/2005/Atom"}
-  
+  #POST: Returns the raw internet data for new facts, or None if we couldn't get any. Does not change any joke state
+  def downloadJokes(self):
     log.joke("Obtaining new",self.title+"s")
-    log.network.low("Suppressing network for joke acquisition")
     try:
-      webContent, code = self.connection.get(self.url, query = self.query, headers = self.headers, timeout = self.TIMEOUT)
+      webContent, code = self.connection.get(self.url, query = self.query, headers = self.headers, timeout = self.TIMEOUT, forceLog = False)
     except OSError:
       log.web.debug("Socket Timed Out!")
-      return False
+      return None
     log.joke.debug("Code Received:",code)
-    if code != 200: return False
+    if code != 200: return None
+    return webContent
+    
+  #PRE : webContent may be data from downloadJokes, otherwise we download it here
+  def acquireJokes(self, webContent = None): #Gets new fact(s)
+    if webContent is None:
+      webContent = self.downloadJokes()
+      if webContent is None: return False
     
     #Here is where most of the struggle comes from
     self.onJokeAcquire(webContent, self.jokes)
@@ -330,11 +348,17 @@ class InternetFact(SimpleFileJoke, SimpleFact):
     
     return True
     
-  def getJoke(self):
+  #We only download if we might run out. Without the lock we can't load, so if we haven't loaded yet we download just in case
+  def fetchJoke(self):
+    if self.isLoaded and len(self.jokes) > 0:
+      return None
+    return self.downloadJokes()
+    
+  def getJoke(self, fetched = None):
     self.load()
     
     if len(self.jokes) == 0:
-      if not self.acquireJokes():
+      if not self.acquireJokes(fetched):
         return self.defaultJoke #DEFAULT FACT
         
     #Will remove jokes so we don't get repeat jokes
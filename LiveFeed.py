@@ -0,0 +1,116 @@
+#Lets website clients watch a group's messages as they come in
+#Groups publish each message they get, and every subscriber (one for each open live page) gets a copy in its own buffer
+#  A subscriber that falls too far behind is dropped rather than letting its messages pile up
+
+from collections import deque
+import json
+import threading
+
+import Logging as log
+import Metrics
+
+BUFFER_SIZE = 100 #Most unread messages a subscriber can have before it is dropped
+HEARTBEAT   = 15  #Seconds a subscriber waits for messages before it should send something so the connection stays open
+
+class Subscriber():
+  def __init__(self, groupNum, size = BUFFER_SIZE):
+    self.groupNum = groupNum
+    self.size = size
+    self.dropped = False #Set when the subscriber fell behind or the feed closed. No more messages will be given
+    self._buffer = deque() #Deque of (eventID, data string)
+    self._condition = threading.Condition()
+
+  def __repr__(self):
+    return "<LiveFeed.Subscriber object for Group " + str(self.groupNum) + ">"
+
+  #Adds a message to the buffer
+  #POST: Returns False if the subscriber has been dropped
+  def push(self, item):
+    with self._condition:
+      if self.dropped:
+        return False
+      if len(self._buffer) >= self.size:
+        log.web("Live feed subscriber fell behind, dropping", self)
+        DROPPED.inc()
+        self.close()
+        return False
+      self._buffer.append(item)
+      self._condition.notify()
+      return True
+
+  #Waits for messages
+  #PRE : timeout is the most seconds to wait
+  #POST: Returns a list of (eventID, data) for all messages since the last get. Will be empty if none came before the timeout
+  #      Returns None if the subscriber has been dropped
+  def get(self, timeout = HEARTBEAT):
+    with self._condition:
+      self._condition.wait_for(lambda: self._buffer or self.dropped, timeout)
+      if self.dropped:
+        return None
+      toRet = list(self._buffer)
+      self._buffer.clear()
+      return toRet
+
+  def close(self):
+    with self._condition:
+      self.dropped = True
+      self._buffer.clear()
+      self._condition.notify_all()
+
+_subscribers = {} #Dict of group number : set of Subscribers
+_lock = threading.Lock() #Subscribers are added from website threads while messages are published from the message handling thread
+SUBSCRIBERS = Metrics.gauge("live_feed_subscribers", "Open live feeds", function = lambda: getSubscriberCount())
+DROPPED = Metrics.counter("live_feed_dropped_total", "Live feed subscribers dropped for falling behind")
+
+#POST: Returns a new Subscriber that will get all messages published for the group
+def subscribe(groupNum):
+  subscriber = Subscriber(groupNum)
+  with _lock:
+    _subscribers.setdefault(groupNum, set()).add(subscriber)
+  log.web("New live feed subscriber for Group", groupNum)
+  return subscriber
+
+def unsubscribe(subscriber):
+  subscriber.close()
+  with _lock:
+    groupSet = _subscribers.get(subscriber.groupNum)
+    if groupSet:
+      groupSet.discard(subscriber)
+      if not groupSet:
+        del _subscribers[subscriber.groupNum]
+
+def getSubscriberCount(groupNum = None):
+  with _lock:
+    if groupNum is not None:
+      return len(_subscribers.get(groupNum, ()))
+    return sum(len(groupSet) for groupSet in _subscribers.values())
+
+#Sends a message to everyone watching the group
+#PRE : group is the Group the message is for, message is a Commands.Message
+def publish(group, message):
+  with _lock:
+    if group.ID not in _subscribers:
+      return #Nobody is watching, no need to do anything
+    subscribers = list(_subscribers[group.ID])
+
+  #Get user's name (or system) for display
+  userName = message.getUserString()
+  if message.isUser():
+    user = group.users.getUserFromID(message.user_id)
+    if user:
+      userName = user.getName()
+  images = message.getAttachments("image") or []
+  data = json.dumps({"id": message.get("id"), "userName": userName, "text": message.get("text"), "created_at": message.get("created_at"),
+                     "avatar_url": message.get("avatar_url"), "images": [image['url'] for image in images]})
+
+  for subscriber in subscribers:
+    if not subscriber.push((message.get("id"), data)):
+      unsubscribe(subscriber)
+
+#Ends every feed. Used when the server is shutting down
+def closeAll():
+  with _lock:
+    subscribers = [subscriber for groupSet in _subscribers.values() for subscriber in groupSet]
+    _subscribers.clear()
+  for subscriber in subscribers:
+    subscriber.close()
@@ -0,0 +1,182 @@
+#Keeps counters, gauges and histograms of what the server is doing so they can be watched from the website
+#Metrics are written in the Prometheus text format. Each metric can have labels, like the group number, to split up its values
+#  Example:
+#    messagesHandled = Metrics.counter("messages_handled_total", "Messages handled", ["group"])
+#    messagesHandled.inc(group = 12)
+
+from bisect import bisect_left
+import threading
+import time
+
+PREFIX = "botsly_" #Added to the name of every metric
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = {} #Dict of full name : Metric, in the order they were made
+_lock = threading.Lock()
+
+#Makes label values safe to put in quotes
+def escapeLabel(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatValue(value):
+  if value == float("inf"):
+    return "+Inf"
+  if type(value) == float and value.is_integer():
+    return str(int(value))
+  return repr(value) if type(value) == float else str(value)
+
+#Base class for all metrics
+class Metric():
+  TYPE = "untyped"
+
+  def __init__(self, name, helpText, labels = ()):
+    self.name = PREFIX + name
+    self.helpText = helpText
+    self.labelNames = tuple(labels)
+    self._values = {} #Dict of tuple of label values : value
+    self._lock = threading.Lock() #Metrics are changed from the server threads and timers at the same time
+
+  def __repr__(self):
+    return "<Metrics." + type(self).__name__ + " object: " + self.name + ">"
+
+  #POST: Returns the tuple of label values for the given keyword labels. Raises KeyError if a label is missing
+  def _key(self, labels):
+    if len(labels) != len(self.labelNames):
+      raise KeyError("Metric " + self.name + " takes labels " + repr(self.labelNames) + ", got " + repr(tuple(labels)))
+    return tuple(str(labels[name]) for name in self.labelNames)
+
+  #Formats the labels for one line of exposition. extra is a list of (name, value) to add on the end
+  def _formatLabels(self, key, extra = ()):
+    pairs = list(zip(self.labelNames, key)) + list(extra)
+    if not pairs:
+      return ""
+    return "{" + ",".join('{}="{}"'.format(name, escapeLabel(value)) for name, value in pairs) + "}"
+
+  #POST: Returns a list of (label key, value) for every value of the metric
+  def getValues(self):
+    with self._lock:
+      return list(self._values.items())
+
+  #POST: Returns a list of lines in the Prometheus text format
+  def expose(self):
+    lines = ["# HELP {} {}".format(self.name, self.helpText), "# TYPE {} {}".format(self.name, self.TYPE)]
+    for key, value in sorted(self.getValues()):
+      lines.append(self.name + self._formatLabels(key) + " " + formatValue(value))
+    return lines
+
+#A value that only goes up, like number of requests
+class Counter(Metric):
+  TYPE = "counter"
+
+  def inc(self, amount = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+#A value that goes up and down, like the number of things waiting
+#If a function is given, it is called to get the values every time the metric is exposed
+#  The function should return a number (if there are no labels), or a dict of tuple of label values : number
+class Gauge(Metric):
+  TYPE = "gauge"
+
+  def __init__(self, name, helpText, labels = (), function = None):
+    super().__init__(name, helpText, labels)
+    self.function = function
+
+  def set(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+  def inc(self, amount = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def dec(self, amount = 1, **labels):
+    self.inc(-amount, **labels)
+
+  def getValues(self):
+    if self.function:
+      values = self.function()
+      if not isinstance(values, dict):
+        return [((), values)]
+      return [(tuple(str(label) for label in (key if type(key) == tuple else (key,))), value) for key, value in values.items()]
+    return super().getValues()
+
+#Counts values (like how long things took) into buckets, and keeps their sum and count
+class Histogram(Metric):
+  TYPE = "histogram"
+
+  def __init__(self, name, helpText, labels = (), buckets = DEFAULT_BUCKETS):
+    super().__init__(name, helpText, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      if key not in self._values:
+        #Count for each bucket (plus one for +Inf), sum, count
+        self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+      entry = self._values[key]
+      entry[0][bisect_left(self.buckets, value)] += 1 #Buckets are "less than or equal to", so bisect_left
+      entry[1] += value
+      entry[2] += 1
+
+  #To be used like "with histogram.time(group = 12):". Observes the seconds the block took
+  def time(self, **labels):
+    return _Timer(self, labels)
+
+  def getValues(self):
+    with self._lock:
+      return [(key, [list(entry[0]), entry[1], entry[2]]) for key, entry in self._values.items()]
+
+  def expose(self):
+    lines = ["# HELP {} {}".format(self.name, self.helpText), "# TYPE {} {}".format(self.name, self.TYPE)]
+    for key, (bucketCounts, total, count) in sorted(self.getValues()):
+      cumulative = 0
+      for bound, bucketCount in zip(self.buckets + (float("inf"),), bucketCounts):
+        cumulative += bucketCount
+        lines.append(self.name + "_bucket" + self._formatLabels(key, [("le", formatValue(float(bound)))]) + " " + str(cumulative))
+      lines.append(self.name + "_sum" + self._formatLabels(key) + " " + formatValue(total))
+      lines.append(self.name + "_count" + self._formatLabels(key) + " " + str(count))
+    return lines
+
+class _Timer():
+  def __init__(self, histogram, labels):
+    self.histogram = histogram
+    self.labels = labels
+
+  def __enter__(self):
+    self.startTime = time.perf_counter()
+    return self
+
+  def __exit__(self, *errors):
+    self.histogram.observe(time.perf_counter() - self.startTime, **self.labels)
+
+#Adds a metric to the registry, or returns the existing one if one with that name was already made (like on module reload)
+def register(metric):
+  with _lock:
+    return _metrics.setdefault(metric.name, metric)
+
+def counter(name, helpText, labels = ()):
+  return register(Counter(name, helpText, labels))
+
+def gauge(name, helpText, labels = (), function = None):
+  return register(Gauge(name, helpText, labels, function))
+
+def histogram(name, helpText, labels = (), buckets = DEFAULT_BUCKETS):
+  return register(Histogram(name, helpText, labels, buckets))
+
+#POST: Returns the metric with the given name (without the prefix), or None
+def getMetric(name):
+  return _metrics.get(PREFIX + name)
+
+#POST: Returns all metrics as a string in the Prometheus text format
+def expose():
+  with _lock:
+    metrics = list(_metrics.values())
+  lines = []
+  for metric in metrics:
+    lines.extend(metric.expose())
+  return "\n".join(lines) + "\n"
@@ -4,15 +4,70 @@
 
 #MsgSearches should be tied to a "Group" and not a "SubGroup" or similar, but it should still differentiate between messages in a subgroup and the main group
 
+import heapq
 import json #For loading and dumping messages to file
+import os
+import re
+import re._parser as regexParser #For checking regex searches before they are run
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice, repeat
 
 import Commands
 import Events
 import Files
+import Groups
 import Logging as log
+import Metrics
+
+SEARCH_THREADS = 4 #Max number of searchers that will be searched at once in a federated search
+PARALLEL_THRESHOLD = 20000 #Archives with at least this many messages will be scanned by a process pool rather than in this process
+SHARD_SIZE = 5000 #Number of messages sent to each process at once in a parallel scan
+LIKE_WINDOW = 60*60*24*7 #Messages younger than this (in seconds) when we last refreshed likes will have their likes refreshed again
+SEARCH_TIME_LIMIT = 5 #Seconds a search can take before it is stopped
+CHECK_TIME_EVERY = 500 #Number of messages scanned between checking if the search has taken too long. Regex searches check every message
+#Limits for regex searches, so one search can't hold up the server. Python regexes can't be stopped part way through a message
+MAX_REGEX_LENGTH = 100
+MAX_REGEX_REPEATS = 1 #Most repeats (like "*", "+", or "{1,50}") that can match more than MAX_SMALL_REPEAT times. Two can already take seconds on one long message (like ".*.*b")
+MAX_SMALL_REPEAT = 10
+
+#Raised when a search takes longer than its time limit
+class SearchTimeout(RuntimeError):
+  pass
 
 _searcherList = {}
+ARCHIVE_SIZE = Metrics.gauge("archive_messages", "Messages in each loaded group archive", ["group"],
+  function = lambda: {searcher.group.ID : len(searcher._messageList) for searcher in list(_searcherList.values()) if searcher._hasLoaded and not isinstance(searcher.group, ArchivedGroup)})
+
+#The process pool is made the first time a large scan happens, and is shared between all searchers
+_processPool = None
+_processPoolLock = threading.Lock() #Searches for several groups can want the pool at the same time
+def getProcessPool():
+  global _processPool
+  with _processPoolLock:
+    if not _processPool:
+      log.analytics("Starting message scanning process pool with", os.cpu_count(), "processes")
+      _processPool = ProcessPoolExecutor()
+    return _processPool
+  
+#Refreshes the like counts of recent messages for every group we have, loading searchers that haven't been loaded yet
+def refreshAllLikes():
+  for group in Groups.getGroupList():
+    if group.groupID:
+      searcher = getSearcher(group)
+      try:
+        searcher.refreshLikes()
+      except (ConnectionError, RuntimeError) as e:
+        log.analytics.error("Could not refresh likes for", searcher, ":", e)
+  
+def shutdownProcessPool():
+  global _processPool
+  with _processPoolLock:
+    if _processPool:
+      _processPool.shutdown(wait = False)
+      _processPool = None
 
 #Its okay if searchers do not exist at post-init. They will simply exist when needed
 def getSearcher(group):
@@ -23,6 +78,186 @@ def getSearcher(group):
     searcher.load()
     _searcherList[group.groupID] = searcher
     return searcher
+    
+#Stands in for a group that no longer exists (like an event that is over), so its archive can still be searched with its family
+#Results are shown as part of the parent group, and names are found from the parent's users
+class ArchivedGroup():
+  def __init__(self, groupID, parent):
+    self.groupID = groupID
+    self.parent = parent
+    self.ID = parent.ID
+    self.users = parent.users
+    
+  def getName(self):
+    return "Old group in " + self.parent.getName()
+    
+#Dict of groupID : parent groupID for every archive in the searches folder. Made the first time it is needed
+#Archives made after this are for groups we have searchers for, so they are found in _searcherList
+_archiveParents = None
+_archiveParentsLock = threading.Lock()
+def getArchiveParents():
+  global _archiveParents
+  with _archiveParentsLock:
+    if _archiveParents is None:
+      _archiveParents = {}
+      prefix, suffix = os.path.basename(Files.getFileName("Group")).split("Group")
+      try:
+        fileNames = Files.getFilesInDir(Searcher.searchesFolder)
+      except FileNotFoundError:
+        fileNames = []
+      for fileName in fileNames:
+        name = os.path.basename(fileName)
+        if name.startswith(prefix+"Group") and name.endswith(suffix):
+          try:
+            with open(fileName) as file:
+              _archiveParents[name[len(prefix+"Group"):-len(suffix) or None]] = Files.read(file) #Only the first line, not the messages
+          except OSError as e:
+            log.save.error("Could not read archive", fileName, ":", e)
+    return _archiveParents
+    
+#Returns the searchers for a group and all of its children (event groups and other subgroups)
+#Archives of groups that no longer exist, but recorded this group as a parent, are also included
+#PRE: group should be a Group object. If it is a SubGroup, its parent's family is searched
+def getFamilySearchers(group):
+  if isinstance(group, Groups.SubGroup) and isinstance(group.parent, Groups.Group):
+    group = group.parent
+  toRet = [getSearcher(group)]
+  for child in Groups.getChildren(group):
+    if child.groupID:
+      toRet.append(getSearcher(child))
+  for groupID, parentID in list(getArchiveParents().items()):
+    if parentID == group.groupID and not Groups.getGroup(groupID):
+      searcher = getSearcher(ArchivedGroup(groupID, group))
+      if searcher not in toRet:
+        toRet.append(searcher)
+  for searcher in list(_searcherList.values()):
+    if searcher not in toRet and searcher.parentID == group.groupID:
+      toRet.append(searcher)
+  return toRet
+  
+#Returns the searchers for every group in the list of internal group IDs given (like the groups a website session can access)
+def getSearchersForGroups(groupNums):
+  toRet = []
+  for groupNum in groupNums:
+    group = Groups.getGroup(groupNum)
+    if group and group.groupID:
+      for searcher in getFamilySearchers(group):
+        if searcher not in toRet:
+          toRet.append(searcher)
+  return toRet
+  
+#Checks that a regex search can't take forever. Nested repeats (like "(a+)+"), alternatives inside repeats (like "(a|a)*"), and backreferences can take
+#  exponential time on some messages, and more than one long repeat (like "a*a*b") can take a very long time on long ones
+#POST: Raises ValueError (or re.error if the regex is not valid) if the regex is not allowed
+def checkRegex(query):
+  if len(query) > MAX_REGEX_LENGTH:
+    raise ValueError("Regex searches can be at most " + str(MAX_REGEX_LENGTH) + " characters")
+  repeats = 0
+  toCheck = [(regexParser.parse(query), False)] #Stack of (pattern, whether it is inside a repeat)
+  while toCheck:
+    pattern, inRepeat = toCheck.pop()
+    for op, value in pattern:
+      if op in (regexParser.GROUPREF, regexParser.GROUPREF_EXISTS):
+        raise ValueError("Regex searches can't have backreferences")
+      if op == regexParser.BRANCH and inRepeat:
+        raise ValueError("Regex searches can't have alternatives (\"|\") inside of repeats")
+      isRepeat = op in (regexParser.MAX_REPEAT, regexParser.MIN_REPEAT, regexParser.POSSESSIVE_REPEAT)
+      if isRepeat:
+        if inRepeat:
+          raise ValueError("Regex searches can't have repeats inside of repeats")
+        if value[1] > MAX_SMALL_REPEAT:
+          repeats += 1
+          if repeats > MAX_REGEX_REPEATS:
+            raise ValueError("Regex searches can have at most " + str(MAX_REGEX_REPEATS) + " repeat" + ("s" if MAX_REGEX_REPEATS > 1 else "") + " (like \"*\" or \"+\")")
+      #Check every pattern inside this one (groups, lookaheads, the thing being repeated, etc.)
+      values = [value]
+      while values:
+        item = values.pop()
+        if isinstance(item, regexParser.SubPattern):
+          toCheck.append((item, inRepeat or isRepeat))
+        elif isinstance(item, (tuple, list)):
+          values.extend(item)
+          
+#Makes a compiled regex for a search query. If permissive, will match any word in the query, otherwise the query as a whole
+#If isRegex, the query is used as a regular expression as-is (raises re.error if it is not valid, or ValueError if it could take too long. See checkRegex)
+def compileQuery(query, permissive = False, isRegex = False):
+  if isRegex:
+    checkRegex(query)
+    return re.compile(query, re.IGNORECASE)
+  words = [word for word in re.split(r"\W+", query) if word] if permissive else [query]
+  if not words:
+    return None
+  return re.compile("|".join(re.escape(word) for word in words), re.IGNORECASE)
+  
+#Returns the number of distinct (case insensitive) matches of the pattern in the text
+def scoreText(pattern, text):
+  return len({match.group().lower() for match in pattern.finditer(text)})
+  
+### Parallel Scan Workers ###
+#These are run in other processes, so must be at module level and only be given simple data
+
+#Returns a list of (index, score) tuples for every text in the shard that matches the pattern
+#Raises SearchTimeout if time.time() passes deadline (if given), checking every checkEvery messages
+def _searchShard(texts, offset, patternString, flags, deadline = None, checkEvery = CHECK_TIME_EVERY):
+  pattern = re.compile(patternString, flags)
+  toRet = []
+  for i in range(len(texts)):
+    if deadline and i % checkEvery == 0 and time.time() > deadline:
+      raise SearchTimeout("Search took longer than " + str(SEARCH_TIME_LIMIT) + " seconds")
+    if texts[i]: #Text can be None for pictures and such
+      score = scoreText(pattern, texts[i])
+      if score:
+        toRet.append((offset+i, score))
+  return toRet
+  
+#A single message found by a search. Holds onto its searcher so that surrounding messages can be found
+class SearchResult():
+  def __init__(self, searcher, index, score = 1):
+    self.searcher = searcher
+    self.index = index #Index of the message in the searcher
+    self.score = score #Number of distinct query words found in the message
+    self.message = searcher.getMessage(index)
+    
+  def __repr__(self):
+    return "<MsgSearch.SearchResult for "+repr(self.searcher)+" at "+str(self.index)+">"
+    
+  #Results are ordered by time. Messages sent at the same time are ordered by group then position
+  def getSortKey(self):
+    return (self.message.get("created_at", 0), self.searcher.group.ID, self.index)
+    
+  #Yields messages around this result, as (index, message) tuples, including this one
+  def getContext(self, numAround = 2):
+    return self.searcher.getContext(self.index, numAround)
+    
+#Searches all the searchers given at the same time, yielding SearchResult objects as a single merged list
+#PRE : searchers is a list of Searcher objects, query is a string
+#      order can be "time" (oldest to newest) or "score" (most matched words first, then newest first)
+#      if maxResults is set, no more than that many results will be yielded
+#      if after is set (only for "time" order), it should be the getSortKey() of a result. Only results after it will be given
+#POST: Returns a generator of SearchResult objects. All searching is done before this returns
+#      Raises re.error or ValueError for regexes that aren't allowed, and SearchTimeout if the search takes longer than timeLimit seconds
+def federatedSearch(searchers, query, permissive = False, order = "time", maxResults = None, isRegex = False, after = None, timeLimit = SEARCH_TIME_LIMIT):
+  pattern = compileQuery(query, permissive, isRegex)
+  if pattern is None or not searchers:
+    return iter(())
+  deadline = time.time() + timeLimit
+  checkEvery = 1 if isRegex else CHECK_TIME_EVERY #One message can take a long time with a regex
+  
+  #Each searcher gives results in chronological order, so when ordering by time each shard only ever needs maxResults results
+  shardLimit = maxResults if order != "score" else None
+  def searchShard(searcher):
+    start = searcher.indexAfter(*after) if (after and order != "score") else 0
+    return list(searcher.search(pattern, start = start, deadline = deadline, limit = shardLimit, checkEvery = checkEvery))
+  
+  log.analytics.debug("Searching", len(searchers), "searchers for", repr(query))
+  with ThreadPoolExecutor(max_workers = min(len(searchers), SEARCH_THREADS)) as pool:
+    shards = list(pool.map(searchShard, searchers))
+    
+  if order == "score":
+    merged = sorted((result for shard in shards for result in shard), key = lambda result: (-result.score, [-i for i in result.getSortKey()]))
+  else:
+    merged = heapq.merge(*shards, key = SearchResult.getSortKey)
+  return islice(merged, maxResults)
 
 class Searcher():
   searchesFolder = "MsgSearchFolder" #The folder where all of the message archives are kept
@@ -44,13 +279,18 @@ class Searcher():
   def __len__(self):
     return len(self._messageList)
     
+  def getMessage(self, index):
+    return Commands.Message(self._messageList[index])
+    
   def __init__(self, group):
     self.group = group #Which Searcher this is
     self.fileName = Files.getFileName(Files.join(self.searchesFolder, "Group"+group.groupID))
+    self.likesFileName = Files.getFileName(Files.join(self.searchesFolder, "Likes"+group.groupID))
     #Will only be set on load. This is the groupID of the parent group 
     self.parentID = None #(stored because many groups we save messages for groups that no longer exist on GroupMe)
     self._messageList = [] #This contains all known messages in chronological order. Values should all be standard strings
     self._hasLoaded = False
+    self.likeWatermark = None #The time likes were last refreshed. Loaded from file on first refresh
     
   ### File Functions ###
     
@@ -85,6 +325,17 @@ class Searcher():
         log.save.error("Invalid JSON Saving on server stop")
         
   
+  def loadLikeWatermark(self):
+    try:
+      with open(self.likesFileName, "r") as file:
+        self.likeWatermark = float(Files.read(file))
+    except (FileNotFoundError, ValueError):
+      log.save.debug("No like watermark for",self,", refreshing only the most recent window")
+      
+  def saveLikeWatermark(self):
+    with Files.SafeOpen(self.likesFileName, "w") as file:
+      Files.write(file, str(self.likeWatermark))
+  
   ### Interface Functions ###
 
   def appendMessage(self, message): #Only to be used externally. Saves automatically
@@ -99,8 +350,133 @@ class Searcher():
     self._messageList.append(dict(message)) #To dict because it should be a Commands.Message object
     self.save()
     
+  #Returns the index of the first message that would be sorted after a SearchResult with the given sort key
+  #PRE: Messages should be in chronological order
+  def indexAfter(self, createdAt, groupNum, index):
+    if not self._hasLoaded:
+      self.load()
+    low, high = 0, len(self._messageList)
+    while low < high: #Find the first message sent at or after createdAt
+      middle = (low + high) // 2
+      if self._messageList[middle].get("created_at", 0) < createdAt:
+        low = middle + 1
+      else:
+        high = middle
+    #Messages sent at the same time are sorted by group, then by index
+    while low < len(self._messageList) and self._messageList[low].get("created_at", 0) == createdAt and (self.group.ID, low) <= (groupNum, index):
+      low += 1
+    return low
+    
+  #Searches through all messages for a query, yielding SearchResult objects in chronological order
+  #Large archives are split into shards and searched by the process pool, unless there is a limit
+  #  A limited search usually stops early, which the pool can't do because it sends out every shard at once
+  #PRE: pattern should be a compiled regex (from compileQuery) or a string to be compiled
+  #     start is the index to start searching from
+  #     if limit is given, no more than that many results are yielded
+  #     if deadline is given, raises SearchTimeout once time.time() passes it, checking every checkEvery messages
+  def search(self, pattern, permissive = False, start = 0, deadline = None, limit = None, checkEvery = CHECK_TIME_EVERY):
+    if not self._hasLoaded:
+      self.load()
+    if type(pattern) == str:
+      pattern = compileQuery(pattern, permissive)
+      if pattern is None: return
+    if limit is not None and limit <= 0:
+      return
+    if limit is None and len(self._messageList) - start >= PARALLEL_THRESHOLD:
+      try:
+        for index, score in self.scanParallel(_searchShard, pattern.pattern, pattern.flags, deadline, checkEvery, start = start):
+          yield SearchResult(self, index, score)
+        return
+      except (OSError, BrokenProcessPool) as e: #If we can't use other processes, just do it here
+        log.analytics.error("Parallel search failed for", self, "searching serially:", e)
+        shutdownProcessPool()
+    found = 0
+    for i in range(start, len(self._messageList)):
+      if deadline and (i - start) % checkEvery == 0 and time.time() > deadline:
+        raise SearchTimeout("Search took longer than " + str(SEARCH_TIME_LIMIT) + " seconds")
+      text = self._messageList[i].get("text")
+      if text: #Text can be None for pictures and such
+        score = scoreText(pattern, text)
+        if score:
+          yield SearchResult(self, i, score)
+          found += 1
+          if found == limit:
+            return
+          
+  #Splits the archive into shards and runs worker on each in the process pool, returning all the worker's results in message order
+  #PRE : worker must be a module-level function taking (shard, offset, *arg) and returning a list.
+  #      shard is a list of the "key" value of each message (or whole messages if key is None), offset is the index of the shard's first message
+  #      messages before start are not scanned
+  #POST: Returns a generator of the items of each shard's list, in shard order
+  def scanParallel(self, worker, *arg, key = "text", start = 0):
+    if not self._hasLoaded:
+      self.load()
+    offsets = range(start, len(self._messageList), SHARD_SIZE)
+    if key is None:
+      shards = (self._messageList[offset:offset+SHARD_SIZE] for offset in offsets)
+    else:
+      shards = ([message.get(key) for message in self._messageList[offset:offset+SHARD_SIZE]] for offset in offsets)
+    argLists = [repeat(value) for value in arg]
+    for results in getProcessPool().map(worker, shards, offsets, *argLists):
+      yield from results
+          
+  #Yields (index, message) tuples for the messages around a given index, including the message itself
+  def getContext(self, index, numAround = 2):
+    for i in range(max(index-numAround, 0), min(index+numAround+1, len(self._messageList))):
+      yield i, self.getMessage(i)
+    
   ### Cache Functions ###
   
+  #Downloads recent messages again and updates the "favorited_by" lists of archived messages that have changed
+  #Only messages that were younger than LIKE_WINDOW the last time this ran are downloaded
+  #POST: Returns the number of messages that were changed
+  def refreshLikes(self):
+    self.load()
+    if self.likeWatermark is None:
+      self.loadLikeWatermark()
+    startTime = time.time()
+    cutoff = (self.likeWatermark or startTime) - LIKE_WINDOW
+    
+    #Map message ids to where they are in the archive, going back only as far as we need to
+    recentIndex = {}
+    for i in range(len(self._messageList)-1, -1, -1):
+      if self._messageList[i].get("created_at", 0) < cutoff:
+        break
+      recentIndex[self._messageList[i]["id"]] = i
+    
+    log.analytics("Refreshing likes for", len(recentIndex), "messages in", self)
+    numChanged = 0
+    nextSearch = "" #The id to search from before_id next
+    while recentIndex:
+      #Messages come in newest-oldest order
+      response = self.group.handler.get("/".join(("groups",self.group.groupID,"messages")), query = {"limit":100, "before_id":nextSearch})
+      if response.code == 200:
+        messageStack = response['messages']
+        if len(messageStack) == 0:
+          break
+        nextSearch = messageStack[-1]['id']
+        for message in messageStack:
+          index = recentIndex.get(message['id'])
+          if index is not None and self._messageList[index].get("favorited_by") != message.get("favorited_by"):
+            self._messageList[index]["favorited_by"] = message.get("favorited_by")
+            numChanged += 1
+        if messageStack[-1].get("created_at", 0) < cutoff: #We have gone past the window
+          break
+      elif response.code == 304: #If we have hit the end of messages
+        break
+      elif response.code == 500:
+        log.analytics.low("Hit message limit, sleeping")
+        time.sleep(1)
+      else:
+        raise RuntimeError("ERROR IN REFRESH LIKES: RECEIVED response.code " + str(response.code))
+        
+    log.analytics("Updated likes on", numChanged, "messages in", self)
+    if numChanged:
+      self.save()
+    self.likeWatermark = startTime
+    self.saveLikeWatermark()
+    return numChanged
+  
   #This generates the cache from scratch.
   def GenerateCache(self):
     self.load() #Loads if has not been loaded
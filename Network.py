@@ -5,6 +5,7 @@
 import datetime
 import json
 import http.client
+import re
 import socket #For error handling
 import time
 import uuid #For poster message sending
@@ -14,6 +15,7 @@ import Events
 import Files
 import Groups
 import Logging as log
+import Metrics
 import Users
 
 IP_ADDRESS = None #Will be set when we need a bot, and can be reset
@@ -21,6 +23,15 @@ SERVER_CONNECTION_PORT = 7502
 IP_UPDATE_TIME         = 60*60*2 #2 Hours between checks
 _lastIPUpdateTime = 0
 
+API_LATENCY   = Metrics.histogram("api_request_seconds", "Time taken by requests to other websites", ["endpoint"])
+API_RESPONSES = Metrics.counter("api_responses_total", "Responses from other websites by status code", ["endpoint", "code"])
+
+#Parts of a url that are ids (all numbers, or long strings with numbers like bot ids)
+ID_SEGMENT = re.compile(r"(?<=/)(?:\d+|(?=[^/]*\d)[0-9A-Za-z_-]{16,})(?=/|$)")
+#Turns a url into an endpoint name for metrics, so "/v3/groups/1234/messages" becomes "/v3/groups/:id/messages"
+def getEndpointName(target, extension):
+  return target + ID_SEGMENT.sub(":id", extension)
+
 #This is an object so that I can use "Response.code" and then just have the return object be a dict
 class Response(dict):
   def setCode(self, code):
@@ -60,15 +71,24 @@ class Connection():
       log.network.low("Query:", queryString)
     if headers: log.network.debug("Headers:", headers)
     if body: log.network.debug("Body:", body)
+    endpoint = method + " " + getEndpointName(self.target, extension)
+    startTime = time.perf_counter()
     try:
       handle.request(method, extension+queryString, body = (body.encode(self.encoding) if body else None), headers = headers)
       self.lastRequest = time.time() #Set the time when we finished the last request
     except socket.gaierror:
       log.network.error("Wow. The internet is down. Well that's a problem")
+      API_RESPONSES.inc(endpoint = endpoint, code = "error")
       raise ConnectionError("Internet Down. Please Check Connection")
       
-    response = handle.getresponse()
-    data, code = response.read().decode("utf-8"), response.getcode()
+    try:
+      response = handle.getresponse()
+      data, code = response.read().decode("utf-8"), response.getcode()
+    except Exception:
+      API_RESPONSES.inc(endpoint = endpoint, code = "error")
+      raise
+    API_LATENCY.observe(time.perf_counter() - startTime, endpoint = endpoint)
+    API_RESPONSES.inc(endpoint = endpoint, code = code)
     log.network("Response Code:", code)
     log.network.debug("Response Headers:", response.getheaders())
     log.network.debug("Response Message:", data if len(data) < self.debugCutoffLength or forceLog else (data[:1000] + "..."))
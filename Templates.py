@@ -0,0 +1,50 @@
+#Simple templates for generated website pages
+#A template is parsed once into pieces of static text and named slots (like "%content%"), so rendering a page
+#  writes each piece straight to the response rather than copying the whole page for every replacement
+
+import re
+
+SLOT_PATTERN = re.compile(r"%([A-Za-z]\w*)%") #A slot looks like "%name%"
+
+class Template():
+  #PRE : text is the template text. Every "%name%" in it is a slot
+  def __init__(self, text, encoding = "utf-8"):
+    self.encoding = encoding
+    self.slots = set() #The names of all the slots in the template
+    #List of (staticBytes, slotName) tuples. staticBytes is written first, then the slot (which is None for the last piece)
+    self._parts = []
+
+    lastEnd = 0
+    for match in SLOT_PATTERN.finditer(text):
+      name = match.group(1)
+      self._parts.append((text[lastEnd:match.start()].encode(encoding), name))
+      self.slots.add(name)
+      lastEnd = match.end()
+    self._parts.append((text[lastEnd:].encode(encoding), None))
+
+  def __repr__(self):
+    return "<Templates.Template object with slots " + repr(sorted(self.slots)) + ">"
+
+  #Writes the template to "write", which should be a function that takes bytes
+  #PRE : each keyword is the value of a slot. A value can be a string (or anything that can be made a string),
+  #        or a function which will be called with no arguments at that point in the template (so it can write content itself)
+  #POST: Slots that were not given values are written as-is
+  def render(self, write, **values):
+    for static, slot in self._parts:
+      if static:
+        write(static)
+      if slot is None:
+        continue
+      value = values.get(slot)
+      if value is None:
+        write(("%" + slot + "%").encode(self.encoding))
+      elif callable(value):
+        value()
+      else:
+        write(str(value).encode(self.encoding))
+
+  #Renders the template into a string
+  def renderText(self, **values):
+    toRet = []
+    self.render(toRet.append, **values)
+    return b"".join(toRet).decode(self.encoding)
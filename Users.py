@@ -1,12 +1,187 @@
 #Interface for Users in a GroupMe group. Each user stores data like analytics and is responsible for saving said data
 #A "User" is tied to a "Group"
+#The parts of a person that are the same in every group (real name, names, token, addresses) are kept once in an Identity,
+#  which every User with that GroupMe id shares
 
 import json
+import os
 import re
+import threading
+import time
 
+import Events
 import Files
 import Groups
 import Logging as log
+
+#Tells a group's UserList that a name in it changed, so it knows to remake its NameMatcher
+#PRE: group may be None, or a group that doesn't have users yet (while it is being made)
+def nameChanged(group):
+  userList = getattr(group, "users", None)
+  if isinstance(userList, UserList):
+    userList.nameVersion += 1
+  
+#Everything about a GroupMe user that is the same in every group they are in. There is one for each GroupMe user id
+class Identity():
+  def __init__(self, ID = None):
+    self.ID = ID
+    self.realName = None #Person's real name
+    self.token = None
+    self.alias = []
+    self.addresses = {} #Dict of address type : address
+    self.updated = {} #Dict of "realName", "token", or "address:" + address type : time it was last set, so merging keeps the newest
+    self.users = {} #Dict of group ID : User for every group this person has been loaded in. Not saved
+    
+  def __repr__(self):
+    return "<Users.Identity object for " + str(self.ID) + ">"
+    
+  def __setattr__(self, name, value):
+    object.__setattr__(self, name, value)
+    if name in ("realName", "token") and "updated" in self.__dict__:
+      self.updated[name] = time.time()
+    if name in ("realName", "alias"):
+      self.nameChanged()
+    
+  #Names from the Identity are used in every group the person is in, so all of those groups need to know
+  def nameChanged(self):
+    for user in list(self.__dict__.get("users", {}).values()):
+      nameChanged(user.group)
+    
+  #POST: Returns True if "theirs" should replace "ours". If both are set, the newer one wins and the conflict is logged
+  def _isNewer(self, key, ours, theirs, when):
+    if not ours:
+      return True
+    newer = when is not None and when > self.updated.get(key, 0)
+    log.user.error("Conflicting", key, "for", self, "- keeping", repr(theirs if newer else ours), "instead of", repr(ours if newer else theirs))
+    return newer
+    
+  #Adds names and addresses from another identity or old user data
+  #If both have a different real name, token, or address of the same type, the one set most recently is kept
+  #  A real name that isn't kept is still added as an alias
+  #PRE: updated is the time the given data was last changed (like its file's modified time), or a dict like our "updated"
+  #     If a time isn't known, what we already have is kept
+  def merge(self, realName = None, token = None, alias = (), addresses = {}, updated = None):
+    getTime = updated.get if isinstance(updated, dict) else (lambda key: updated)
+    alias = list(alias)
+    if realName and realName != self.realName:
+      oldName = self.realName
+      if self._isNewer("realName", oldName, realName, getTime("realName")):
+        self.realName = realName
+        self._setUpdated("realName", getTime("realName"))
+        realName = oldName
+      if realName: #The other name is still a name for them
+        alias.append(realName)
+    if token and token != self.token and self._isNewer("token", self.token, token, getTime("token")):
+      self.token = token
+      self._setUpdated("token", getTime("token"))
+    newAliases = [name for name in dict.fromkeys(alias) if name not in self.alias]
+    if newAliases:
+      self.alias.extend(newAliases)
+      self.nameChanged()
+    for addressType in addresses:
+      key = "address:" + addressType
+      address = addresses[addressType]
+      if address != self.addresses.get(addressType) and self._isNewer(key, self.addresses.get(addressType), address, getTime(key)):
+        self.addresses[addressType] = address
+        self._setUpdated(key, getTime(key))
+        
+  def _setUpdated(self, key, when):
+    if when is None:
+      self.updated.pop(key, None)
+    else:
+      self.updated[key] = when
+      
+  def getSaveData(self):
+    return {key : getattr(self, key) for key in ["ID", "realName", "token", "alias", "addresses", "updated"]}
+    
+#Holds the Identity for every GroupMe user id, saved in one file with one JSON record per line
+#Like UserStore, saving only updates the record in memory, and Events.SyncSave writes the file later
+class IdentityRegistry():
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self._identities = None #Dict of ID : Identity. Loaded the first time one is needed
+    self._records = {} #Dict of ID : JSON record string
+    self._dirty = False
+    self._lock = threading.Lock() #The file is written from the SyncSave thread
+    
+  def load(self):
+    self._identities = {}
+    if not os.path.exists(self.fileName):
+      return
+    with open(self.fileName) as file:
+      for line in file:
+        line = line.rstrip("\n")
+        if not line: continue
+        try:
+          data = json.loads(line)
+          identity = Identity(data["ID"])
+          identity.merge(data["realName"], data["token"], data["alias"], data["addresses"], data.get("updated", {}))
+        except (KeyError, ValueError): #This means the data was corrupted on save
+          log.user.error("Could not load identity record in", self.fileName, "is probably corrupted:", line)
+          continue
+        self._identities[identity.ID] = identity
+        self._records[identity.ID] = line
+    log.user("Loaded", len(self._identities), "user identities")
+    
+  #POST: Returns the Identity for the GroupMe user id, making a new one if there isn't one
+  #      If ID is None, returns a new Identity that is not kept
+  def get(self, ID):
+    if ID is None:
+      return Identity()
+    with self._lock:
+      if self._identities is None:
+        self.load()
+      if ID not in self._identities:
+        self._identities[ID] = Identity(ID)
+      return self._identities[ID]
+      
+  #POST: Returns the Identity for the GroupMe user id, or None if there isn't one
+  def find(self, ID):
+    with self._lock:
+      if self._identities is None:
+        self.load()
+      return self._identities.get(ID)
+      
+  #POST: Returns False if nothing about the identity changed since it was last saved, so nothing needs to be written
+  def save(self, identity):
+    if identity.ID is None:
+      return False
+    line = json.dumps(identity.getSaveData())
+    with self._lock:
+      if self._records.get(identity.ID) == line:
+        return False
+      self._records[identity.ID] = line
+      self._dirty = True
+    Events.SyncSave().addObject(self)
+    return True
+    
+  #Called by Events.SyncSave
+  def _save(self):
+    with self._lock:
+      if not self._dirty:
+        return
+      log.save.low("Writing", len(self._records), "user identities")
+      lines = list(self._records.values())
+      self._dirty = False
+    try:
+      with Files.AtomicOpen(self.fileName, "w") as file:
+        for line in lines:
+          Files.write(file, line)
+    except OSError: #So it is written with the next change
+      with self._lock:
+        self._dirty = True
+      raise
+        
+identities = IdentityRegistry(Files.getFileName("identities"))
+
+#POST: Returns a list of the User objects for a GroupMe user id in every group they are loaded in
+def getUsersByID(ID):
+  identity = identities.find(ID)
+  return list(identity.users.values()) if identity else []
+  
+#Makes an attribute of a User that is really stored in its Identity
+def _identityAttribute(name):
+  return property(lambda self: getattr(self.identity, name), lambda self, value: setattr(self.identity, name, value))
       
 #A user without an id but not a token
 #Contains methods for data-manipulation
@@ -17,6 +192,7 @@ class User():
   # BotMaster
   # key : value
   # key : value
+  #NOTE: This is for the old one-file-per-user folders. Users are now saved in a UserStore
   @staticmethod
   def loadUser(fileName, groupReference):
     with open(fileName) as file:
@@ -24,20 +200,48 @@ class User():
       log.save.low("Loading ",userType,"from",fileName)
       return globals()[userType](groupReference).load(file) #Load arbitrary class
       
+  #Same as loadUser, but from a UserStore record like {"type": "User", "data": {...}}
+  @staticmethod
+  def loadRecord(record, groupReference):
+    return globals()[record["type"]](groupReference).loadData(record["data"]) #Load arbitrary class
+      
   #Just makes another user with the names of the other one
+  #All names but the GroupMe name come with the Identity, so only that needs copying
   @classmethod
   def copy(cls, group, user):
     toRet = cls(group, user.ID)
-    toRet.realName = user.realName
     toRet.GMName = user.GMName
-    toRet.token = user.token
-    toRet.alias = toRet.alias.copy()
     return toRet
 
   _keyAddrDefault = "_main"
+  
+  #These are the same for this person in every group
+  realName = _identityAttribute("realName") #Person's real name
+  token    = _identityAttribute("token")
+  alias    = _identityAttribute("alias")
+  
+  #Setting the ID also finds the user's Identity
+  @property
+  def ID(self):
+    return self._ID
+    
+  @ID.setter
+  def ID(self, value):
+    object.__setattr__(self, "_ID", value)
+    oldIdentity = self.__dict__.get("identity")
+    identity = identities.get(value)
+    if oldIdentity is not None and oldIdentity is not identity and oldIdentity.ID is None: #Keep anything set before we had an ID
+      identity.merge(oldIdentity.realName, oldIdentity.token, oldIdentity.alias, oldIdentity.addresses, oldIdentity.updated)
+    object.__setattr__(self, "identity", identity)
 
   def __repr__(self):
     return "<Users."+type(self).__name__+" object. Name: " + self.getName() + ">"
+    
+  #Real names and aliases are set on the Identity, which handles telling groups. The GroupMe name is only in this group
+  def __setattr__(self, name, value):
+    object.__setattr__(self, name, value)
+    if name == "GMName":
+      nameChanged(self.__dict__.get("group"))
       
   #Needs a group reference, the ID can be set either in "load" or when user first loaded
   def __init__(self, group, groupMeID = None):
@@ -46,24 +250,18 @@ class User():
   
     #Group reference
     self.group = group
-    self.ID = groupMeID
-    self.realName = None #Person's real name
-    self.GMName = None #GroupMe Name
-    self.token = None
-    self.alias = []
+    self.ID = groupMeID #Real name, token, and aliases come from the Identity for this ID
+    self.GMName = None #GroupMe Name. Can be different in each group
     self.data = {} #Container for storing generic data about the user. Useful for other modules getting passed the user
     
     self._hasLoaded = False
   
-  def getFileName(self):
-    if not self.ID: log.error("Attempted to get file name for unloaded or unset user")
-    return Files.getFileName(Files.join(Files.getGroupFolder(self.group), "Users", self.ID or "DEFAULT_USER"))
-    
   #Just adds an alias. No name update required
   #POST: Returns True if the name did not exist, False otherwise
   def addAlias(self, name):
     if name not in self.alias:
       self.alias.append(name)
+      self.identity.nameChanged()
       self.save()
       return True
     return False
@@ -71,6 +269,7 @@ class User():
   def removeAlias(self, name):
     try:
       self.alias.pop(self.alias.index(name))
+      self.identity.nameChanged()
       self.save()
       return True
     except IndexError:
@@ -136,46 +335,60 @@ class User():
     if type(address) != str:
       raise TypeError("setAddress expected string, got " + str(type(address)))
     
-    key = 'address'
-    if key not in self.data:
-      self.data[key] = {}
-    if type(addressType) == str:
-      self.data[key][addressType] = address
-    else: 
-      self.data[key][self._keyAddrDefault] = address
+    if type(addressType) != str:
+      addressType = self._keyAddrDefault
+    self.identity.addresses[addressType] = address
+    self.identity.updated["address:" + addressType] = time.time()
     self.save()
       
   def getAddress(self, addressType = None):
-    key = 'address'
     try:
       if type(addressType) == str and addressType:
-        return self.data[key][addressType]
+        return self.identity.addresses[addressType]
       else:
-        return self.data[key][self._keyAddrDefault]
+        return self.identity.addresses[self._keyAddrDefault]
     except KeyError:
       return False #If key error, we don't have the address requested
   
+  #The user's data is given to its group's UserStore, and the Identity to the IdentityRegistry, which will write them to file soon
   def save(self):
-    log.save.low("Saving",type(self).__name__,"data for", self.ID or self.getName())
-    with Files.SafeOpen(self.getFileName(), "w") as file: #Will save data, first line being the class __name__
-      Files.write(file, type(self).__name__)
-      self._save(file)
+    identityChanged = identities.save(self.identity)
+    if self.group.users.store.saveUser(self) or identityChanged:
+      log.save.low("Saving",type(self).__name__,"data for", self.ID or self.getName())
+      self.group.bumpVersion() #Names or addresses might have changed
+      if identityChanged: #Then they changed in every group this person is in
+        for user in list(self.identity.users.values()):
+          if user.group is not self.group:
+            user.group.bumpVersion()
     return self
     
-  def _save(self, writeHandle): #This is where you have class specific saving things.
-    Files.saveAttrTable(self, writeHandle, ["ID", "realName", "GMName", "token", "alias", "data"])
-      
+  #POST: Returns a dict of everything that needs to be saved. Must have the user's "ID"
+  def getSaveData(self): #This is where you have class specific saving things.
+    return {key : getattr(self, key) for key in ["ID", "GMName", "data"]}
+    
   #LOAD MUST RETURN SELF
-  def load(self, fileHandle): #Can load necessary data from file here
+  #PRE: data is a dict from getSaveData
+  #     Data saved before Identities existed also has "realName", "token", "alias", and addresses in data["address"]. These are moved to the Identity
+  #     updated is when that data was last changed, so the newest is kept if another group had different data for this person
+  def loadData(self, data, updated = None):
     if not self._hasLoaded:
-      Files.loadAttrTable(self, fileHandle)
+      self.ID = data["ID"] #Get our identity first
+      self.GMName = data.get("GMName")
+      self.data = data.get("data") or {}
+      if "alias" in data or "address" in self.data:
+        self.identity.merge(data.get("realName"), data.get("token"), data.get("alias") or (), self.data.pop("address", {}), updated)
+        identities.save(self.identity)
       self._hasLoaded = True
     return self
+      
+  #LOAD MUST RETURN SELF
+  def load(self, fileHandle): #Can load necessary data from an old user file here
+    text = Files.read(fileHandle)
+    return self.loadData(json.loads(text) if "{" in text else {"ID": self.ID}, os.fstat(fileHandle.fileno()).st_mtime)
     
   def delete(self):
-    log.save.low("Saving",type(self).__name__,"data for", self.ID or self.getName())
-    success = Files.deleteFile(self.getFileName())
-    log.save.low("Deletion", "succeeded" if success else "failed")
+    log.save.low("Deleting",type(self).__name__,"data for", self.ID or self.getName())
+    self.group.users.store.removeUser(self)
 
 #The user mimic will store only a few values for itelf, and resolve all other values to its parent
 class UserMimic(User):
@@ -211,19 +424,35 @@ class UserMimic(User):
       setattr(self._parentObj, name, value) #Set value in parent
       return
     object.__setattr__(self, name, value) #Set own value
+    if name == "GMName":
+      nameChanged(self.__dict__.get("group"))
     
+  #Our names come from the parent's Identity, so if we are already in our group, we move to the new Identity's users
+  #  so that renames still reach our group's UserList
   def setParent(self, parent):
-    if isinstance(parent, User):
-      self._parentObj = parent
-    else:
+    if not isinstance(parent, User):
       raise TypeError("UserMimic cannot set parent to '"+str(type(parent))+"', must be 'User'")
+    oldParent = self._parentObj
+    self._parentObj = parent
+    userList = getattr(self.group, "users", None)
+    if isinstance(userList, UserList) and any(user is self for user in userList.IDDict.values()):
+      if oldParent is not None and oldParent.identity.users.get(self.group.ID) is self:
+        del oldParent.identity.users[self.group.ID]
+      parent.identity.users[self.group.ID] = self
+      userList.nameVersion += 1
       
   def getParent(self):
     return self._parentObj
     
-  def _save(self, handle):
-    Files.saveAttrTable(self, handle, ["GMName"])
-    Files.write(handle, self.ID)
+  def getSaveData(self):
+    return {"GMName": self.GMName, "ID": self.ID}
+    
+  def loadData(self, data):
+    self.GMName = data["GMName"]
+    self._tempID = str(data["ID"])
+    #We should be loaded after the parent has loaded
+    self._parentObj = self.group.parent.users.getUserFromID(self._tempID)
+    return self
     
   def load(self, handle):
     Files.loadAttrTable(self, handle)
@@ -240,12 +469,221 @@ class UserMimic(User):
 class Bot():
   pass
 
+#All the users in a group, saved in one file with one JSON record per line
+#Saving a user only updates its record in memory. Events.SyncSave writes the file later, so many saves become one write
+class UserStore():
+  def __init__(self, userList):
+    self.group = userList.group
+    folder = Files.getGroupFolder(self.group)
+    self.fileName = Files.getFileName(Files.join(folder, "userData"))
+    self.legacyFolder = Files.join(folder, "Users") #Where each user used to have their own file
+    self._records = {} #Dict of user ID : JSON record string, in the order they are written
+    self._dirty = set() #IDs of users that have changed since the file was last written
+    self._lock = threading.Lock() #The file is written from the SyncSave thread
+    self.deleted = False #Set when the group is deleted, so nothing is written
+    
+  #POST: Returns a list of all saved users. If there is no file yet, users are moved over from the old one-file-per-user folder
+  def load(self):
+    if not os.path.exists(self.fileName):
+      return self.migrate()
+    users = []
+    with open(self.fileName) as file:
+      for line in file:
+        line = line.rstrip("\n")
+        if not line: continue
+        try:
+          record = json.loads(line)
+          user = User.loadRecord(record, self.group)
+        except (KeyError, ValueError): #This means the data was corrupted on save
+          log.user.error("Could not load user record in", self.fileName, "is probably corrupted:", line)
+          continue
+        users.append(user)
+        self._records[record["data"]["ID"]] = line
+        if "alias" in record["data"]: #Saved before Identities. Rewrite it without the parts now in the Identity
+          self.saveUser(user)
+    return users
+    
+  #Loads users from the old folder, writes them all to the new file, then removes the old folder
+  def migrate(self):
+    users = []
+    if os.path.isdir(self.legacyFolder):
+      for userFile in Files.getFilesInDir(self.legacyFolder):
+        try:
+          users.append(User.loadUser(userFile, self.group))
+        except KeyError: #This means the data was corrupted on save
+          log.user.error("Could not load user from file:",userFile,"is probably corrupted")
+      log.save("Moving", len(users), "users for Group", self.group.ID, "into", self.fileName)
+      for user in users:
+        self.saveUser(user)
+      #Names and addresses are only in the Identities now, so they must be written too before the old files are gone
+      try:
+        self._save()
+        identities._save()
+      except OSError as e:
+        log.save.error("Could not save moved users for Group", self.group.ID, "so keeping", self.legacyFolder, ":", e)
+        return users
+      Files.deleteFolder(self.legacyFolder)
+    return users
+    
+  #POST: Returns False if nothing about the user changed since it was last saved, so nothing needs to be written
+  def saveUser(self, user):
+    data = user.getSaveData()
+    line = json.dumps({"type": type(user).__name__, "data": data})
+    with self._lock:
+      if self._records.get(data["ID"]) == line:
+        return False
+      self._records[data["ID"]] = line
+      self._dirty.add(data["ID"])
+    Events.SyncSave().addObject(self)
+    return True
+    
+  def removeUser(self, user):
+    with self._lock:
+      if self._records.pop(user.ID, None) is None:
+        return
+      self._dirty.add(user.ID)
+    Events.SyncSave().addObject(self)
+    
+  #Stops any more writes. The group's folder is being deleted
+  def delete(self):
+    with self._lock:
+      self.deleted = True
+      self._dirty.clear()
+    Events.SyncSave().removeObject(self)
+      
+  #Called by Events.SyncSave
+  def _save(self):
+    with self._lock:
+      if self.deleted or not self._dirty:
+        return
+      log.save.low("Writing", len(self._dirty), "changed users for Group", self.group.ID)
+      lines = list(self._records.values())
+      self._dirty.clear()
+    with Files.AtomicOpen(self.fileName, "w") as file:
+      for line in lines:
+        Files.write(file, line)
+
+#Finds users from names in text. Made from all the names in a UserList, and only remade when a name changes
+#Like UserList.getUser always has, GroupMe names are checked first, then real names, then any other names
+#  and in each of those the longest name found anywhere in the text wins
+class NameMatcher():
+  STRIP_CHARS = "\"'.,!?/\\" #Stripped from the right of names so "\b" matches names like Jordan "4 Stillballs"
+  
+  def __init__(self, users):
+    realNames = {}
+    GMNames   = {}
+    alii      = {} #Sounds better than aliases
+    for user in users:
+      if user.GMName: GMNames[user.GMName] = user
+      if user.realName: realNames[user.realName] = user
+      for name in user.alias:
+        if not name in alii:
+          alii[name] = user
+    #List of (compiled pattern, list of users for each group in the pattern)
+    self.tiers = [self.compileNames(nameDict) for nameDict in (GMNames, realNames, alii)]
+    
+  #Makes one pattern for all the names. It finds each name (between word breaks, ignoring case) at every position in the text
+  #  Names are tried longest first, so at each position the first group to match is the longest name there
+  @classmethod
+  def compileNames(cls, nameDict):
+    patterns = []
+    users = []
+    for name in sorted(nameDict, key = len, reverse = True):
+      stripped = name.rstrip(cls.STRIP_CHARS)
+      if stripped:
+        patterns.append("(" + re.escape(stripped) + ")")
+        users.append(nameDict[name])
+    if not patterns:
+      return None, users
+    #The lookahead lets matches overlap, so a short name can't hide a longer one that starts inside it
+    return re.compile(r"(?=\b(?:" + "|".join(patterns) + r")\b)", re.IGNORECASE), users
+    
+  #POST: Returns the user with the highest priority name in text, or None if no names are found
+  def find(self, text):
+    for pattern, users in self.tiers:
+      if pattern is None:
+        continue
+      best = None
+      for match in pattern.finditer(text):
+        if best is None or match.lastindex < best: #The group number is the name's place in the longest-first list
+          best = match.lastindex
+          if best == 1: break #Can't do better than the longest name
+      if best:
+        log.user.debug("Found user:", users[best-1])
+        return users[best-1]
+    return None
+
+#Finds users whose names are close to some text, for when there is a typo or only part of a name
+#Every name is split into trigrams (each run of three letters, with spaces added on the ends), and names are scored by
+#  how many trigrams they share with the text: 2 * shared / (text trigrams + name trigrams). 1 is an exact match
+FUZZY_THRESHOLD = 0.5 #Lowest score that is a good enough guess to use
+class TrigramIndex():
+  CLEAN_PATTERN = re.compile(r"[^\w ]+") #Punctuation is ignored when comparing names
+  MAX_WINDOW = 3 #Most words in a row of the text that are compared to names at once
+  MIN_WINDOW_LENGTH = 3 #Shorter words (like "is") match too many names by chance
+  
+  def __init__(self, users):
+    self.names = [] #List of (number of trigrams, user) for every name
+    self.index = {} #Dict of trigram : list of positions in names with that trigram
+    for user in users:
+      for name in set(filter(None, [user.GMName, user.realName] + list(user.alias))):
+        trigrams = self.getTrigrams(name)
+        if not trigrams: continue
+        for trigram in trigrams:
+          self.index.setdefault(trigram, []).append(len(self.names))
+        self.names.append((len(trigrams), user))
+        
+  @classmethod
+  def getTrigrams(cls, text):
+    text = "  " + " ".join(cls.CLEAN_PATTERN.sub("", text.lower()).split()) + " "
+    if not text.strip(): return set()
+    return {text[i:i+3] for i in range(len(text) - 2)}
+    
+  #POST: Returns a list of up to "limit" (score, user) tuples, highest score first. Each user is only in the list once
+  def search(self, text, limit = 5):
+    trigrams = self.getTrigrams(text)
+    shared = {} #Dict of name position : trigrams shared with text
+    for trigram in trigrams:
+      for position in self.index.get(trigram, ()):
+        shared[position] = shared.get(position, 0) + 1
+    best = {} #Dict of user ID : (score, user)
+    for position, count in shared.items():
+      numTrigrams, user = self.names[position]
+      score = 2 * count / (len(trigrams) + numTrigrams)
+      if user.ID not in best or score > best[user.ID][0]:
+        best[user.ID] = (score, user)
+    return sorted(best.values(), key = lambda pair: pair[0], reverse = True)[:limit]
+    
+  #Finds the closest name anywhere in the text, like "Zoee" in "is Zoee colle". Each run of up to MAX_WINDOW words is scored
+  #  on its own, because the other words in the text would lower the score of the whole text
+  #POST: Returns the closest user if their score is at least threshold, otherwise None
+  def find(self, text, threshold = FUZZY_THRESHOLD):
+    words = self.CLEAN_PATTERN.sub("", text.lower()).split()
+    best = None
+    for size in range(1, self.MAX_WINDOW + 1):
+      for start in range(len(words) - size + 1):
+        window = " ".join(words[start:start+size])
+        if len(window) < self.MIN_WINDOW_LENGTH: continue
+        candidates = self.search(window, 1)
+        if candidates and (best is None or candidates[0][0] > best[0]):
+          best = candidates[0]
+    if best and best[0] >= threshold:
+      log.user.debug("Found user", best[1], "by close name with score {:.2f}".format(best[0]))
+      return best[1]
+    return None
+
 #Class that is an interface for finding users
 #NOTE on Savable Data: All connections are made on startup. The UserList does not save any data about users.
 class UserList():
   def __iter__(self): #So can do "for a in UserList"
     for user in self.userList:
       yield user
+      
+  def __len__(self):
+    return len(self.IDDict)
+    
+  def __contains__(self, userObj): #So can do "if user in UserList"
+    return self.IDDict.get(userObj.ID) is userObj
 
   #On init, this is just an empty object with no users (even if there are users that can be loaded)
   #Users will be loaded after communication with internet
@@ -255,45 +693,71 @@ class UserList():
     self.hasVerified = False
     self.group = group #Group reference
     
-    self.dirName = Files.join(Files.getGroupFolder(self.group), "Users")
+    self.store = UserStore(self) #Saves all our users
     
     #Note: position in userList is not static 
-    self.userList = [] #This will be where users are normally stored
-    self.IDDict = {}
+    self.IDDict = {} #This will be where users are normally stored. Dict of ID : user, in the order they were added
     self.aliasList = {}
-    
-    #Creates folder if it does not exist
-    Files.createFolder(self.dirName)
+    self.nameVersion = 0 #Goes up whenever a name of one of our users changes, or users are added or removed
+    self._matcher = None #NameMatcher for finding users by name
+    self._matcherVersion = None #The name version the matcher was made at
+    self._trigrams = None #TrigramIndex for finding users by close names
+    self._trigramsVersion = None
+    
+  #A list of all users, in the order they were added. Changing the list does not change the UserList
+  @property
+  def userList(self):
+    return list(self.IDDict.values())
+    
+  #POST: Returns a dict of ID : user for all current users. Can be given to getChanges later
+  def snapshot(self):
+    return self.IDDict.copy()
+    
+  #PRE : before and after are dicts of ID : user, like from snapshot
+  #POST: Returns a tuple of (list of users in after but not before, list of users in before but not after)
+  @staticmethod
+  def getChanges(before, after):
+    added   = [user for ID, user in after.items()  if ID not in before]
+    removed = [user for ID, user in before.items() if ID not in after]
+    return added, removed
     
   ### User Manipulation ###
     
+  #Removes the group's users from their Identities without deleting their data. Used when the group deletes itself
+  def releaseIdentities(self):
+    for userObj in self.userList:
+      identity = getattr(userObj, "identity", None)
+      if identity and identity.users.get(self.group.ID) is userObj:
+        del identity.users[self.group.ID]
+        
   #Expects local user data to be loaded already
   def loadAllUsers(self):
-    files = Files.getFilesInDir(self.dirName)
-    log.user("Loading {: 2} users for Group".format(len(files)), self.group.ID)
-    for userFile in files:
-      try:
-        user = User.loadUser(userFile, self.group)
-        self.addUser(user)
-      except KeyError: #This means the data was corrupted on save
-        log.user.error("Could not load user from file:",userFile,"is probably corrupted")
+    users = self.store.load()
+    log.user("Loading {: 2} users for Group".format(len(users)), self.group.ID)
+    for user in users:
+      self.addUser(user)
         
       
   def addUser(self, userObj):
     if userObj.ID in self.IDDict:
       raise RuntimeError("Tried to add duplicated user to group " + repr(self.group))
   
-    if not userObj in self.userList:
-      self.userList.append(userObj)
     self.IDDict[userObj.ID] = userObj
+    identity = getattr(userObj, "identity", None) #A UserMimic won't have one until it has a parent
+    if identity:
+      identity.users[self.group.ID] = userObj
+    self.nameVersion += 1
+    self.group.bumpVersion()
     return userObj
     
   def removeUser(self, userObj):
-    if userObj in self.userList:
-      self.userList.pop(self.userList.index(userObj))
-    if userObj.ID in self.IDDict:
-      del self.IDDict[userObj.ID]
+    self.IDDict.pop(userObj.ID, None)
+    identity = getattr(userObj, "identity", None)
+    if identity and identity.users.get(self.group.ID) is userObj:
+      del identity.users[self.group.ID]
     userObj.delete()
+    self.nameVersion += 1
+    self.group.bumpVersion()
     
   #getUser expects "userIdent" to be either a user's id, or a string containing a user's groupMe name or real name
   #POST: If user found, returns a "User" object. On failure returns "None". Will raise TypeError if input is not a string
@@ -307,40 +771,35 @@ class UserList():
         userIdent = userIdent.replace("'s", "") #Get rid of any possessives
         log.user("Searching string for member",userIdent)
         
-        realNames = {}
-        GMNames   = {}
-        alii      = {} #Sounds better than aliases
-        for user in self.userList:
-          if user.GMName: GMNames[user.GMName] = user
-          if user.realName: realNames[user.realName] = user
-          for name in user.alias:
-            if not name in alii:
-              alii[name] = user
-            
-        def searchNames(searchDict):
-          #Search through the input string for names, starting with the longest names first to avoid conflicts
-          #E.G. If we have "Ian George" and "Ian George 4 Lyfe" we want to get "Ian George 4 Lyfe" first always
-          for name in sorted(searchDict, key = len, reverse = True):
-            log.user.low("Testing name:",repr(name))
-            #Find a match for the name (between word breaks or an at sign) ignoring case. Also strip out all the punctation on the right so "\b" matches names like Jordan "4 Stillballs"
-            if re.search(r"\b"+name.rstrip("\"'.,!?/\\")+r"\b", userIdent, re.IGNORECASE):
-              log.user.debug("Found user:", searchDict[name])
-              return searchDict[name]
-          return False
-         
-        log.user.low("Searching names for GMNames")
-        toRet = searchNames(GMNames)
-        if toRet: return toRet
-        log.user.low("Searching names for realNames")
-        toRet = searchNames(realNames)
-        if toRet: return toRet
-        log.user.low("Searching names for alii")
-        toRet = searchNames(alii)
+        #Search through the input string for names, starting with the longest names first to avoid conflicts
+        #E.G. If we have "Ian George" and "Ian George 4 Lyfe" we want to get "Ian George 4 Lyfe" first always
+        toRet = self.getNameMatcher().find(userIdent)
         if toRet: return toRet
           
       log.user.low("Could not find user from identification", userIdent, "in Group", self.group.ID)
       return None
       
+  #POST: Returns the NameMatcher for all users, remaking it if any names have changed since it was made
+  def getNameMatcher(self):
+    if self._matcher is None or self._matcherVersion != self.nameVersion:
+      log.user.low("Making name matcher for Group", self.group.ID)
+      self._matcherVersion = self.nameVersion
+      self._matcher = NameMatcher(self.userList)
+    return self._matcher
+    
+  #POST: Returns the TrigramIndex for all users, remaking it if any names have changed since it was made
+  def getTrigramIndex(self):
+    if self._trigrams is None or self._trigramsVersion != self.nameVersion:
+      log.user.low("Making trigram index for Group", self.group.ID)
+      self._trigramsVersion = self.nameVersion
+      self._trigrams = TrigramIndex(self.userList)
+    return self._trigrams
+    
+  #Finds a user whose name is close to text, for when getUser can't find an exact name
+  #POST: Returns the closest user if they are at least as close as threshold, otherwise None
+  def getUserFuzzy(self, text, threshold = FUZZY_THRESHOLD):
+    return self.getTrigramIndex().find(text.lstrip("@").replace("'s", ""), threshold)
+    
   def getUserFromID(self, userIdent):
     return self.getUser(userIdent, onlyID = True)
     
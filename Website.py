@@ -1,86 +1,367 @@
 #Interface for handling web requests and serving files
+import base64
+import binascii
 import datetime
+import gzip
+import hashlib
+import heapq
+import html
 import http.cookies
 import http.client
 import json
+import mimetypes
 import re
 import os
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
 from textwrap import dedent
-from time import time
-from urllib.parse import urlparse, parse_qs, urlencode
+from time import perf_counter, time
+from urllib.parse import parse_qs, urlencode
 from uuid import uuid4
+import zlib
 
 import Events
 import Files
 import Groups
+import LiveFeed
 import Logging as log
+import Metrics
 import MsgSearch
+import Templates
 ### CONFIG AREA ###
 ID_LIFETIME = datetime.timedelta(days = 3).total_seconds() #We will tell to store cookie forever, but if its older than this we require a new sign-in
 ID_FILE     = Files.getFileName("Server_UUIDs")
 DEFAULT_DIR = "http"
 ADMIN_PASSWORD = "shiboleeth" #I think that's the Canvas page for MST
+CACHE_MAX_SIZE = 1024**2 #Files larger than this will not be kept in memory, they are read from disk each request
+CACHE_TOTAL_SIZE = 16 * 1024**2 #Most bytes of files kept in memory at once. The least recently used files are dropped first
+CACHE_RECHECK  = 1 #Seconds between checking if a cached file has changed on disk
+GZIP_MIN_SIZE  = 512 #Responses smaller than this are not worth compressing
+GZIP_LEVEL     = 6 #Compression level for generated pages. Static files are compressed once, so they use the max
 
 NEVER_EXPIRES = "; expires=Fri, 31 Dec 9999 23:59:59 GMT" #Concatenate with cookies to make them never expire
 
 ### SECURITY MODULE ###
 """The security module handles keeping track of uuids sent to the website in a request of web resources"""
-#The _idDict is a dict of uuid : tuple(last page access, [list of group IDs allowed in])
-_idDict = None
+#Keeps every session in memory. Changes are written to file by Events.SyncSave, not while answering a request
+class SessionStore():
+  PURGE_BATCH = 20 #Most expired sessions removed each time a session is registered
+  
+  def __init__(self, fileName, lifetime):
+    self.fileName = fileName
+    self.lifetime = lifetime
+    self._sessions = {} #Dict of uuid : [last sign-in time, set of group IDs allowed in]
+    #Heap of (last sign-in time, uuid). A session gets a new entry every sign-in, so entries older than the session's time are skipped
+    self._expiry = []
+    self._lock = threading.Lock() #Saving happens on the SyncSave thread
+    self._dirty = False
+    self._hasLoaded = False
+    
+  def load(self):
+    self._hasLoaded = True
+    try:
+      with open(self.fileName, "r") as file:
+        log.save("Loading ID file")
+        data = json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+      log.save("ID file not found, using none")
+      return
+    with self._lock:
+      for uuid, (lastTime, groups) in data.items():
+        self._sessions[uuid] = [lastTime, set(groups)]
+        self._expiry.append((lastTime, uuid))
+      heapq.heapify(self._expiry)
+    self.purge() #Once file loaded, purge all expired IDs
+    
+  #Called by Events.SyncSave
+  def _save(self):
+    with self._lock:
+      if not self._dirty:
+        return
+      data = {uuid : [lastTime, list(groups)] for uuid, (lastTime, groups) in self._sessions.items()}
+      self._dirty = False
+    log.save("Saving ID file")
+    with Files.AtomicOpen(self.fileName, "w") as file:
+      json.dump(data, file)
+      
+  def _markDirty(self):
+    self._dirty = True
+    Events.SyncSave().addObject(self)
+    
+  #Removes sessions that have not signed in for longer than the lifetime
+  #PRE : If limit is given, no more than that many sessions will be removed
+  #POST: Returns the number of sessions removed
+  def purge(self, limit = None):
+    if not self._hasLoaded: self.load()
+    removed = 0
+    cutoff = time() - self.lifetime
+    with self._lock:
+      while self._expiry and self._expiry[0][0] < cutoff and (limit is None or removed < limit):
+        lastTime, uuid = heapq.heappop(self._expiry)
+        session = self._sessions.get(uuid)
+        if session and session[0] == lastTime: #Otherwise the user has signed in since
+          del self._sessions[uuid]
+          removed += 1
+      if len(self._expiry) > 2 * len(self._sessions) + self.PURGE_BATCH: #Too many old entries, rebuild it
+        self._expiry = [(session[0], uuid) for uuid, session in self._sessions.items()]
+        heapq.heapify(self._expiry)
+    if removed:
+      log.security("Purged", removed, "expired session"+("s" if removed > 1 else ""))
+      self._markDirty()
+    return removed
+    
+  #POST: Returns the session for a uuid, or None if it does not exist or has expired
+  def get(self, uuid):
+    if not self._hasLoaded: self.load()
+    session = self._sessions.get(uuid)
+    if session and time() <= session[0] + self.lifetime:
+      return session
+    return None
+    
+  def canAccess(self, uuid, groupNum):
+    if groupNum == None:
+      return True #If doesn't belong to a group, always true
+    session = self.get(uuid)
+    return bool(session) and groupNum in session[1] #Return true if the user has this group saved, otherwise false
+    
+  #Adds a group to the uuid's session, making a new session if the uuid has none
+  #POST: Returns the uuid of the session
+  def register(self, uuid, groupNum):
+    if not self._hasLoaded: self.load()
+    self.purge(self.PURGE_BATCH)
+    timeNow = int(time())
+    with self._lock:
+      session = self._sessions.get(uuid) if uuid else None
+      if session:
+        session[0] = timeNow
+        session[1].add(groupNum)
+      else:
+        uuid = str(uuid4())
+        self._sessions[uuid] = [timeNow, {groupNum}]
+      heapq.heappush(self._expiry, (timeNow, uuid))
+    self._markDirty()
+    return uuid
+    
+  #POST: Returns a list of the group numbers the uuid is allowed to access
+  def getGroups(self, uuid):
+    session = self.get(uuid)
+    return list(session[1]) if session else []
+    
+sessions = SessionStore(ID_FILE, ID_LIFETIME)
+
 #This goes through all uuids and checks their last time
 def securityPurge():
-  global _idDict
-  if _idDict == None: securityLoad()
-  timeNow = int(time())
-  for user in _idDict.copy():
-    if timeNow > _idDict[user][0] + ID_LIFETIME: #If the user has not logged for however long
-      del _idDict[user] #Remove them from the list
-  securitySave()
-
-def securityLoad():
-  global _idDict
-  try:
-    with open(ID_FILE, "r") as file:
-      log.save("Loading ID file")
-      _idDict = json.load(file)
-    #Once file loaded, purge all non-existing IDs
-    securityPurge()
-  except (FileNotFoundError, json.decoder.JSONDecodeError):
-    _idDict = {}
-    log.save("ID file not found, using none")
+  sessions.purge()
   
-def securitySave():
-  log.save("Saving ID file")
-  with open(ID_FILE, "w") as file:
-    json.dump(_idDict, file)
-    
 def securityCanAccess(uuid, groupNum):
-  if _idDict == None: securityLoad()
-  if groupNum == None:
-    return True #If doesn't belong to a group, always true
-  if uuid == None:
-    return False #Otherwise if has no idea, always false
-    
-  try:
-    return groupNum in _idDict[uuid][1] #Return true if the user has this group saved, otherwise false
-  except KeyError:
-    return False #If the ID no longer exists, return false
+  return sessions.canAccess(uuid, groupNum)
     
 #Makes a new UUID, adds it to the list of UUIDs, returns it
 def securityRegister(uuid, groupNum):
-  global _idDict
-  if _idDict == None: securityLoad()
+  return sessions.register(uuid, groupNum)
+    
+#POST: Returns a list of the group numbers the uuid is allowed to access
+def securityGetGroups(uuid):
+  return sessions.getGroups(uuid)
+    
+#POST: Returns True if data of the given content type (like "text/html; charset=utf-8") should be gzipped
+def isCompressible(contentType):
+  contentType = (contentType or "").split(";")[0].strip()
+  return contentType.startswith("text/") or contentType in ["application/javascript", "application/json", "image/svg+xml"]
+  
+#Cursors for paged searches are the sort key of the last result sent, so the next page can start right after it
+def encodeCursor(sortKey):
+  return base64.urlsafe_b64encode(json.dumps(list(sortKey)).encode("ascii")).decode("ascii")
+  
+#POST: Returns the sort key from a cursor. Raises ValueError if the cursor is not valid
+def decodeCursor(cursor):
   try:
-    _idDict[uuid][1].append(groupNum)
-    _idDict[uuid][0] = int(time())
-    return uuid
-  except KeyError:
-    uuid = str(uuid4())
-    #Create a new entry
-    _idDict[uuid] = [int(time()), [groupNum, ]]
-    return uuid
-  finally:
-    securitySave()
+    createdAt, groupNum, index = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii"))
+  except (binascii.Error, UnicodeError, TypeError, ValueError): #JSONDecodeError is a ValueError
+    raise ValueError("Invalid cursor: " + repr(cursor)) from None
+  if not all(type(value) in (int, float) for value in (createdAt, groupNum, index)):
+    raise ValueError("Invalid cursor: " + repr(cursor))
+  return createdAt, groupNum, index
+  
+REQUESTS = Metrics.counter("website_requests_total", "Website requests by method", ["method"])
+
+### STATIC FILE CACHE ###
+"""Files served from disk (and templates loaded by generated pages) are kept in memory along with validators
+   so that browsers can be told their copy is still good"""
+class CachedFile():
+  def __init__(self, path, stat, data = None):
+    self.path  = path
+    self.mtime = stat.st_mtime
+    self.size  = stat.st_size
+    self.data  = data #Will be None if the file is too large to cache
+    self.checkedAt = time() #Last time we checked the file on disk
+    if data is not None:
+      self.etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+    else:
+      self.etag = '"{:x}-{:x}"'.format(int(self.mtime), self.size)
+    self.lastModified = formatdate(self.mtime, usegmt = True)
+    self.contentType  = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    self.compressible = data is not None and len(data) >= GZIP_MIN_SIZE and isCompressible(self.contentType)
+    self.gzipEtag = self.etag[:-1] + '-gzip"' #The compressed file is a different representation, so needs a different tag
+    self._text = None
+    self._template = None
+    self._gzipData = None
+    
+  #POST: Returns the gzipped file data, compressing only the first time. Returns None if the file shouldn't be compressed
+  def getGzipData(self):
+    if not self.compressible:
+      return None
+    if self._gzipData is None:
+      log.web.low("Compressing file for cache:", self.path)
+      self._gzipData = gzip.compress(self.data, 9)
+    return self._gzipData
+    
+  def getText(self, encoding):
+    if self._text is None:
+      self._text = self.data.decode(encoding)
+    return self._text
+    
+  #The file parsed as a template. Only parsed the first time, and again if the file changes
+  def getTemplate(self, encoding):
+    if self._template is None:
+      self._template = Templates.Template(self.getText(encoding), encoding = encoding)
+    return self._template
+    
+  #Checks the request headers to see if the client already has this version of the file
+  def isNotModified(self, headers):
+    if 'If-None-Match' in headers: #If-None-Match is used instead of If-Modified-Since if it exists
+      tags = [tag.strip() for tag in headers['If-None-Match'].split(",")]
+      tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+      return "*" in tags or self.etag in tags or self.gzipEtag in tags
+    if 'If-Modified-Since' in headers:
+      try:
+        return int(self.mtime) <= parsedate_to_datetime(headers['If-Modified-Since']).timestamp()
+      except (TypeError, ValueError): #Invalid date
+        pass
+    return False
+    
+  #Checks the If-Range header. If the client's copy is out of date, it should get the whole file rather than part of it
+  def matchesIfRange(self, headers):
+    if 'If-Range' not in headers:
+      return True
+    return headers['If-Range'].strip() in (self.etag, self.lastModified)
+    
+  def addHeaders(self, headers):
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Type"]  = self.contentType
+    headers["ETag"]          = self.etag
+    headers["Last-Modified"] = self.lastModified
+    headers["Cache-Control"] = "no-cache" #Browsers may keep the file, but must check with us before using it
+    if self.compressible:
+      headers["Vary"] = "Accept-Encoding"
+    
+class FileCache():
+  def __init__(self):
+    self._files = OrderedDict() #Dict of path : CachedFile, least recently used first
+    self._size = 0 #Bytes of file data we are holding
+    self._lock = threading.Lock() #Pages that don't hold the message lock can load files at the same time
+    
+  #POST: Returns a CachedFile for the path, reloading it if it has changed on disk. Returns None if no file exists
+  #      If loadData is False and the file isn't cached as it is now, returns an entry with no data that is not kept
+  #        (like for parts of log files, which change all the time, so reading and hashing the whole file would be wasted)
+  def get(self, path, loadData = True):
+    with self._lock:
+      entry = self._files.get(path)
+      if entry:
+        self._files.move_to_end(path)
+        if time() - entry.checkedAt < CACHE_RECHECK:
+          return entry
+    try:
+      stat = os.stat(path)
+    except OSError: #Does not exist
+      self.remove(path)
+      return None
+    if not os.path.isfile(path):
+      return None
+    if entry and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+      entry.checkedAt = time()
+      return entry
+    if not loadData:
+      return CachedFile(path, stat)
+    log.web.low("Loading file into cache:", path)
+    data = None
+    if stat.st_size <= CACHE_MAX_SIZE:
+      with open(path, "rb") as handle:
+        data = handle.read()
+    entry = CachedFile(path, stat, data)
+    with self._lock:
+      self._remove(path)
+      self._files[path] = entry
+      self._size += len(data or b"")
+      while self._size > CACHE_TOTAL_SIZE and len(self._files) > 1:
+        oldPath = next(iter(self._files))
+        log.web.low("Dropping file from cache:", oldPath)
+        self._remove(oldPath)
+    return entry
+    
+  def remove(self, path):
+    with self._lock:
+      self._remove(path)
+      
+  def _remove(self, path):
+    entry = self._files.pop(path, None)
+    if entry:
+      self._size -= len(entry.data or b"")
+    
+  def clear(self):
+    with self._lock:
+      self._files.clear()
+      self._size = 0
+    
+fileCache = FileCache()
+
+#Gets the byte range asked for by a "Range" header
+#PRE : size is the size of the file
+#POST: Returns (first byte, last byte), or None if the whole file should be sent (like for multiple ranges, which we don't do)
+#      Raises ValueError if the range can't be satisfied
+def parseRange(rangeHeader, size):
+  unit, _, ranges = rangeHeader.partition("=")
+  if unit.strip().lower() != "bytes" or "," in ranges:
+    return None
+  first, _, last = ranges.strip().partition("-")
+  try:
+    if not first: #"-500" is the last 500 bytes
+      first, last = max(size - int(last), 0), size - 1
+    else:
+      first, last = int(first), (int(last) if last else None)
+  except ValueError: #Not a number, so not a valid header. Just ignore it
+    return None
+  if last is not None and last < first: #Also not valid
+    return None
+  if first >= size:
+    raise ValueError("Range not satisfiable: " + rangeHeader)
+  return first, (size - 1 if last is None else min(last, size - 1))
+  
+### PAGE FRAGMENT CACHE ###
+#Parts of generated pages made from group data are kept until the group's version changes (see Groups.Group.bumpVersion)
+class FragmentCache():
+  def __init__(self):
+    self._fragments = {} #Dict of (name, group number) : (version, fragment)
+    
+  #PRE : name is the name of the fragment, group is the Group it is made from (or None if made from all groups)
+  #      make is a function with no arguments that makes the fragment
+  #POST: Returns the cached fragment, calling make only if the group has changed since it was made
+  def get(self, name, group, make):
+    key = (name, group.ID if group else None)
+    version = group.getVersion() if group else Groups.getGlobalVersion()
+    cached = self._fragments.get(key)
+    if cached and cached[0] == version:
+      return cached[1]
+    log.web.low("Making page fragment", key)
+    fragment = make()
+    self._fragments[key] = (version, fragment)
+    return fragment
+    
+  def clear(self):
+    self._fragments.clear()
+    
+fragmentCache = FragmentCache()
     
 ### UTILITY FUNCTIONS ###
 
@@ -151,6 +432,75 @@ def extSupport(*arg):
     function._supportedExtensions = list(arg)
     return function
   return addExt
+  
+#Intended to be used as a decorator for do_... functions. The page will be made without holding the message processing lock
+#  This is for pages that stay open a long time, and they must not touch group data without care
+def noLock(function):
+  function._noLock = True
+  return function
+  
+#Matches "12/page.html", where 12 is the group number
+GROUP_PATH = re.compile(r"(\d+)/(.+)")
+#Splits a request path into (group number or None, file name)
+#NOTE ON IMPLEMENTATION: this naiive assumption is that we will never be in a folder besides base or a group number
+def parsePath(path):
+  if "//" in path or "/." in path or path.startswith("."): #Only paths with odd parts like "/../" need to be normalized
+    path = os.path.normpath(path)
+  path = path.strip("/") #Strip these slashes from both sides or else things mess up when loading files
+  match = GROUP_PATH.fullmatch(path)
+  if match:
+    return int(match.group(1)), match.group(2)
+  return None, path
+  
+#A single generated page, with statistics on how it has been used
+class Route():
+  def __init__(self, path, function):
+    self.path = path
+    self.function = function
+    self.useLock = not getattr(function, "_noLock", False)
+    self.hits = 0
+    self.totalTime = 0 #Seconds spent in the function in total
+    self.maxTime = 0
+    
+  #Calls the route's function for a handler, recording how long it took
+  def call(self, handler):
+    startTime = perf_counter()
+    try:
+      return self.function(handler)
+    finally:
+      elapsed = perf_counter() - startTime
+      self.hits += 1
+      self.totalTime += elapsed
+      self.maxTime = max(self.maxTime, elapsed)
+      
+  def getStats(self):
+    return {"function": self.function.__name__, "hits": self.hits, "totalTime": self.totalTime, "maxTime": self.maxTime,
+            "averageTime": (self.totalTime / self.hits) if self.hits else 0}
+      
+#Table of all the pages a handler class can generate. Made once for each class when the module loads, so finding a page is one dict lookup
+#  Pages are found from the do_ methods that exist, so a GET handler will register all the GET pages we can use
+class Router():
+  def __init__(self, handlerClass):
+    self.routes = {} #Dict of "page.html" : Route
+    for method in dir(handlerClass): #We just go through all the methods available in the class
+      if method.startswith("do_"):
+        function = getattr(handlerClass, method)
+        #These should look like "do_page" --> "page.html"
+        #The "if ext else"... because we can have no extension as well
+        for ext in getattr(function, "_supportedExtensions", ["html",]):
+          self.addRoute(method.replace("do_","",1)+("." if ext else "")+ext, function)
+    log.web("Files available for", handlerClass.__name__+":", sorted(self.routes))
+    
+  def addRoute(self, path, function):
+    self.routes[path] = Route(path, function)
+    
+  #POST: Returns the Route for the path, or None if the path is not a generated page
+  def get(self, path):
+    return self.routes.get(path)
+    
+  #POST: Returns a dict of path : stats for every route that has been used
+  def getStats(self):
+    return {path : route.getStats() for path, route in self.routes.items() if route.hits}
 
 def handleRequest(method, handler):
   if method == "POST":
@@ -166,84 +516,89 @@ def handleRequest(method, handler):
 #A handler is instantiated for a single request
 class Handler:
   CHUNK_SIZE   = 1024 * 256 #The size of a buffer chunk to download/upload at once. 1/4 MB
+  STREAM_SIZE  = 1024 * 16  #In a streaming response, data is sent whenever this much is buffered
   PAGE_NO_PATH = "/noFile.html"
   PAGE_DEFAULT = "/selectionScreen.html" #Default webpage to send to
   PAGE_ICON    = "/favicon.ico"
   PAGE_INDEX   = "index.html" #Default per-group page
   PAGE_DEF_GEN = "default.html" #Default file to be generated from
   ENCODING     = "utf-8"     #Encoding to use when sending text data
-  STR_CONTENT  = "%content%" #String to replace for content
-  STR_TITLE    = "%title%"   #String to replace for page title
   COOKIE_ID    = "user_id" #The cookie key for user id
   ERR_NO_GRP   = "No group associated with web request"
   requestsProcessed = 0 #Reset every time server starts
   
-  #A generated file will have two strings in it, a "%title%" and a "%content%" so that the page can be properly generated
-  #The genFiles will be a list of "requestFile"
-  genFiles = None #List of files that should be generated on request (rather than served)
+  router = None #The Router of generated pages. Set for each subclass when the module loads
 
   def __init__(self, handler):
     self.handler = handler
-    self.url     = urlparse(handler.path)
-    self.params  = parse_qs(self.url.query) or {}
+    path, _, query = handler.path.partition("?")
+    self.params  = parse_qs(query) if query else {}
     #log.debug("Path:  ", handler.path)
-    #log.debug("URL:   ", self.url)
     #log.debug("Params:",self.params)
     #List of request headers
     self.headers = handler.headers
-    #The local file path to get files from
-    self.fileName = os.path.normpath(self.url.path).strip(os.sep) #Strip these slashes from both sides or else things mess up when loading files
+    #The local file path to get files from, and the group number if the file is in a group folder
+    #NOTE: A really nice thing about this is that all hyperlinks are paths relative to a folder unless otherwise specified :D
+    self.group, self.fileName = parsePath(path)
     #Organize the cookies (if we have any)
     self.cookies = http.cookies.BaseCookie(self.handler.headers['cookie']) if ('cookie' in self.handler.headers) else None
-    self.group = None #The group number
-    self.groupObj = None #The group object
+    self.groupObj = Groups.getGroup(self.group) if self.group is not None else None #The group object
     self.responseSent = False #After we call "sendResponse" then we can't send headers again
     
-    #We won't actually send data until we are sure that we have it all
-    self.buffer = "".encode(self.ENCODING)
-    
-    #Checking for a group folder
-    try:
-      splitPath = os.path.split(self.fileName) #splits into (everything besides tail, tail)
-      #NOTE: A really nice thing about this is that all hyperlinks are paths relative to a folder unless otherwise specified :D
-      #NOTE ON IMPLEMENTATION: this naiive assumption is that we will never be in a folder besides base or a group number
-      self.group = int(splitPath[0]) #I expect the most folder complexity to be "group/file"
-      self.groupObj = Groups.getGroup(self.group)
-      self.fileName = splitPath[1] #If we have a group, modify the fileName to not contain the group
-    except ValueError: #Not part of a group
-      pass
-    
-    if self.genFiles == None: #If the list of files isn't loaded
-      self.loadGenFiles()
+    #We won't actually send data until we are sure that we have it all (unless we are streaming)
+    #The buffer is a list of bytes objects that are joined once when sent
+    self.buffer = []
+    self.bufferSize = 0
+    self.streaming = False #Set by startStream. Data is sent as it is written
+    self.chunked = False #If streaming with HTTP/1.1 chunked transfer encoding
+    self.compressor = None #If streaming with gzip, the zlib compressor object
     
     #log.debug("Group: ", self.group)
-    log.web.low("New Handler for Url: ", self.url)
-  
-  #This will actually get the list of file we can process from the methods that exist
-  #Note: This will be used by subclasses. So a GET handler will register all the GET pages we can use
-  @classmethod
-  def loadGenFiles(cls):
-    log.web("Loading generated files for",cls.__name__)
-    cls.genFiles = []
-    for method in dir(cls): #We just go through all the methods available in the class
-      if method.startswith("do_"):
-        function = getattr(cls, method)
-        if hasattr(function, "_supportedExtensions"):
-          extList = function._supportedExtensions
-        else:
-          extList = ["html",]
-        for ext in extList: #Adds all the pages to look out for
-          #These should look like "do_page" --> "page.html"
-          #The "if ext else"... because we can have no extension as well
-          cls.genFiles.append(method.replace("do_","",1)+("." if ext else "")+ext)
-    log.web("Files available:", cls.genFiles)
+    log.web.low("New Handler for Url: ", handler.path)
   
+  #Gets the message searchers a search request should look through
+  #The "scope" parameter can be "group" (default, only this group), "family" (this group and all its event groups),
+  #  or "all" (every group the user has access to)
+  def getSearchers(self):
+    scope = self.params.get("scope", ("group",))[0]
+    if scope == "all":
+      return MsgSearch.getSearchersForGroups(securityGetGroups(self.userID))
+    if scope == "family":
+      return MsgSearch.getFamilySearchers(self.groupObj)
+    return [MsgSearch.getSearcher(self.groupObj)]
+    
+  #POST: Returns True if the client said it can accept gzip-encoded responses
+  def acceptsGzip(self):
+    acceptsAny = False
+    for coding in (self.headers.get('Accept-Encoding') or "").lower().split(","):
+      name, _, params = coding.partition(";")
+      try:
+        quality = float(params.split("=", 1)[1]) if "q=" in params else 1
+      except ValueError:
+        quality = 0
+      if name.strip() == "gzip":
+        return quality > 0
+      if name.strip() == "*":
+        acceptsAny = quality > 0
+    return acceptsAny
+    
+  #Compresses a whole response body if the client accepts it and it is worth it, adding the proper headers
+  def compressData(self, data, headers):
+    if 'Content-Encoding' in headers or not isCompressible(headers["Content-Type"] if 'Content-Type' in headers else "text/html"):
+      return data
+    headers["Vary"] = "Accept-Encoding"
+    if len(data) < GZIP_MIN_SIZE or not self.acceptsGzip():
+      return data
+    headers["Content-Encoding"] = "gzip"
+    return gzip.compress(data, GZIP_LEVEL)
+    
   def existsFile(self, path):
-    return os.path.exists(path) and os.path.isfile(path)
+    return fileCache.get(path, loadData = False) is not None
     
   #Handle takes an arbitrary request (GET or POST) and processes it, sending back data if necessary
   def handle(self):
     Handler.requestsProcessed += 1
+    REQUESTS.inc(method = self.handler.command)
     log.net("(#{}) File Requested: '{}'".format(Handler.requestsProcessed, self.fileName) + \
       (" for group {}".format(self.group) if self.group else ""))
       
@@ -257,34 +612,113 @@ class Handler:
       return self.sendFile(self.fileName)
     except Exception as e: #Not BaseException though
       #In the event of any error, set this
-      self.sendError(str(e))
+      if self.responseSent: #A half-sent response can't be finished properly, so the connection must be dropped
+        self.handler.close_connection = True
+      else:
+        self.sendError(str(e))
       raise e #Raise it again so I can see what's going on
       
     
   def loadFile(self, path, shouldError = True): #Simple file loading mechanism
     path = path.strip(os.sep)
-    try:
-      with open(path) as file:
+    entry = fileCache.get(path)
+    if entry and entry.data is not None:
+      return entry.getText(self.ENCODING)
+    if entry: #Too big to be cached
+      with open(path, encoding = self.ENCODING) as file:
         return file.read()
-    except FileNotFoundError:
-      if not DEFAULT_DIR in os.path.split(path)[0]: #Also try to load from the DEFAULT_DIR, because most documents will be there
-        return self.loadFile(os.path.join(DEFAULT_DIR, path))
-      if shouldError: #If we should raise the error, re-raise the error
-        raise FileNotFoundError("Could not load file: " + path)
-      return False
+    if not DEFAULT_DIR in os.path.split(path)[0]: #Also try to load from the DEFAULT_DIR, because most documents will be there
+      return self.loadFile(os.path.join(DEFAULT_DIR, path), shouldError)
+    if shouldError: #If we should raise the error, re-raise the error
+      raise FileNotFoundError("Could not load file: " + path)
+    return False
+    
+  #Loads a file as a Templates.Template. Templates are cached until the file changes
+  def loadTemplate(self, path):
+    path = path.strip(os.sep)
+    entry = fileCache.get(path)
+    if entry and entry.data is not None:
+      return entry.getTemplate(self.ENCODING)
+    if entry: #Too big to be cached
+      return Templates.Template(self.loadFile(path), encoding = self.ENCODING)
+    if not DEFAULT_DIR in os.path.split(path)[0]:
+      return self.loadTemplate(os.path.join(DEFAULT_DIR, path))
+    raise FileNotFoundError("Could not load template: " + path)
     
   #This does the actual loading and sending of files
-  def yieldFile(self, path):
+  #PRE : start is the first byte to read, length is the most bytes to read (None for the rest of the file)
+  def yieldFile(self, path, start = 0, length = None):
     path = path.strip(os.sep)
     with open(path, "rb") as handle:
+      handle.seek(start)
       #yield handle.read() #Super simple way
-      while True:
-        data = handle.read(self.CHUNK_SIZE) #Don't load too much data at once.
+      while length is None or length > 0:
+        data = handle.read(self.CHUNK_SIZE if length is None else min(self.CHUNK_SIZE, length)) #Don't load too much data at once.
         if not data: break #Check if any more data to read
+        if length is not None:
+          length -= len(data)
         yield data #Return this bit of data
         
   def writeText(self, text):
-    self.buffer += text.encode(self.ENCODING)
+    self.writeBytes(text.encode(self.ENCODING))
+    
+  def writeBytes(self, data):
+    self.buffer.append(data)
+    self.bufferSize += len(data)
+    if self.streaming and self.bufferSize >= self.STREAM_SIZE:
+      self.flushStream()
+      
+  #Empties the buffer, returning all the data that was in it
+  def takeBuffer(self):
+    data = b"".join(self.buffer)
+    self.buffer = []
+    self.bufferSize = 0
+    return data
+    
+  #Sends headers and starts a streaming response. After this, writeText will send data to the client as it is written
+  #If the client can use HTTP/1.1, the data is sent with chunked transfer encoding. Otherwise the end of data is marked by closing the connection
+  #PRE: endStream must be called once all data is written
+  def startStream(self, code = http.client.OK, headers = None):
+    if headers == None: headers = Headers()
+    if self.handler.request_version == "HTTP/1.1" and self.handler.protocol_version == "HTTP/1.1":
+      headers["Transfer-Encoding"] = "chunked"
+      self.chunked = True
+    else:
+      self.handler.close_connection = True
+    if 'Content-Encoding' not in headers and isCompressible(headers["Content-Type"] if 'Content-Type' in headers else "text/html"):
+      headers["Vary"] = "Accept-Encoding"
+      if self.acceptsGzip():
+        headers["Content-Encoding"] = "gzip"
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) #16+ is for a gzip header
+    if self.sendResponse(code, headers, sendData = False):
+      self.streaming = True
+      self.flushStream() #Send anything written before the stream started
+      
+  #Sends all buffered data as a chunk of a streaming response
+  def flushStream(self):
+    data = self.takeBuffer()
+    if data and self.compressor:
+      #A sync flush makes sure the browser can show everything we have sent so far
+      data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self.writeChunk(data)
+    
+  def writeChunk(self, data):
+    if not data:
+      return #An empty chunk would signal the end of the response
+    if self.chunked:
+      self.handler.wfile.write("{:X}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+    else:
+      self.handler.wfile.write(data)
+      
+  def endStream(self):
+    if self.streaming:
+      self.flushStream()
+      if self.compressor:
+        self.writeChunk(self.compressor.flush())
+        self.compressor = None
+      if self.chunked:
+        self.handler.wfile.write(b"0\r\n\r\n")
+      self.streaming = False
     
   #Just sends headers and code
   #PRE: Use sendData = False if some other part of the method can add to the buffer, 
@@ -293,6 +727,10 @@ class Handler:
   def sendResponse(self, code = http.client.OK, headers = None, sendData = True):
     if self.responseSent:
       return False
+    if headers == None: headers = Headers()
+    if sendData:
+      data = self.compressData(self.takeBuffer(), headers)
+      headers["Content-Length"] = str(len(data)) #Needed so kept-alive connections know where the response ends
     self.handler.send_response(code)
     if headers != None:
       for key in headers:
@@ -305,16 +743,18 @@ class Handler:
     self.handler.end_headers()
     self.responseSent = True
     if sendData:
-      self.sendData()
+      self.handler.wfile.write(data)
     return True
-        
-  def sendData(self):
-    while len(self.buffer) > 0:
-      self.handler.wfile.write(self.buffer[:self.CHUNK_SIZE])
-      self.buffer = self.buffer[self.CHUNK_SIZE:]
       
+  #Sends an object as a JSON response
+  def sendJSON(self, obj, code = http.client.OK):
+    self.takeBuffer()
+    self.writeText(json.dumps(obj))
+    return self.sendResponse(code, {"Content-Type": "application/json; charset=" + self.ENCODING})
+    
   def sendError(self, errorMsg = "[No message]"):
-    self.buffer = ("Error: " + errorMsg + "\n").encode(self.ENCODING)
+    self.takeBuffer() #Get rid of anything else that was going to be sent
+    self.writeText("Error: " + errorMsg + "\n")
     self.sendResponse(http.client.INTERNAL_SERVER_ERROR)
     
   #This will actually do the sending of the response over a handler
@@ -330,13 +770,9 @@ class Handler:
     path = path.strip("/") #Because I use / for absoulte and it messes up file serving
     
     #Checking for generated files
-    if path in self.genFiles:
-      try:
-        method = getattr(self, "do_"+path.split(".")[0]) #Get the path before .html
-      except AttributeError:
-        log.web.error("No Generation Function for path",path) #Otherwise just return the basic file and log error
-      else: #Don't want to catch errors from these
-        return method() #Call the function
+    route = self.router.get(path) if self.router else None
+    if route:
+      return route.call(self) #Call the function
     
     #log.debug("File requested for path: '"+path+"'")
     if not self.existsFile(path):
@@ -346,15 +782,54 @@ class Handler:
         #return self.redirectFile(self.PAGE_NO_PATH)
         return self.sendFile(self.PAGE_NO_PATH, code = http.client.NOT_FOUND, headers = headers)
         
-    #The page exists
+    #The page exists. Parts of files are read straight from disk, so a growing file (like the log) isn't read in full for each part
+    entry = fileCache.get(path, loadData = not (code == http.client.OK and 'Range' in self.headers))
+    entry.addHeaders(headers)
+    useGzip = entry.compressible and self.acceptsGzip()
+    if useGzip: #A 304 should have the tag of the version we would have sent
+      headers["ETag"] = entry.gzipEtag
+    if code == http.client.OK and entry.isNotModified(self.headers):
+      return self.sendResponse(http.client.NOT_MODIFIED, headers, sendData = False)
+    if code == http.client.OK and 'Range' in self.headers and entry.matchesIfRange(self.headers):
+      try:
+        byteRange = parseRange(self.headers['Range'], entry.size)
+      except ValueError:
+        headers["Content-Range"] = "bytes */{}".format(entry.size)
+        headers["Content-Length"] = "0"
+        return self.sendResponse(http.client.REQUESTED_RANGE_NOT_SATISFIABLE, headers, sendData = False)
+      if byteRange:
+        return self.sendFileRange(path, entry, byteRange, headers)
+    if entry.data is not None:
+      if useGzip:
+        headers["Content-Encoding"] = "gzip"
+        self.writeBytes(entry.getGzipData())
+      else:
+        self.writeBytes(entry.data)
+      return self.sendResponse(code, headers)
+    headers["Content-Length"] = str(entry.size)
     self.sendResponse(code, headers, sendData = False)
-    for data in self.yieldFile(path):
+    for data in self.yieldFile(path, 0, entry.size): #Only as much as we said, in case the file is growing
       self.handler.wfile.write(data) #Incrementally writes data back to web
         
+  #Sends part of a file. Parts are never compressed, because the range is of the file itself
+  #PRE: byteRange is (first byte, last byte) from parseRange
+  def sendFileRange(self, path, entry, byteRange, headers):
+    first, last = byteRange
+    headers["ETag"] = entry.etag
+    headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, entry.size)
+    headers["Content-Length"] = str(last - first + 1)
+    self.sendResponse(http.client.PARTIAL_CONTENT, headers, sendData = False)
+    if entry.data is not None:
+      self.handler.wfile.write(entry.data[first:last+1])
+    else:
+      for data in self.yieldFile(path, first, last - first + 1):
+        self.handler.wfile.write(data)
+        
   def redirectFile(self, path, headers = None):
     if headers == None:
       headers = Headers()
     headers["Location"] = path
+    headers["Content-Length"] = "0"
     return self.sendResponse(http.client.FOUND, headers, sendData = False)
     
 class PostHandler(Handler):
@@ -394,142 +869,253 @@ class PostHandler(Handler):
 class GetHandler(Handler):
   def do_addresses(self):
     log.web.debug("Sending Addresses Screen")
-    toSend = self.loadFile(self.PAGE_DEF_GEN)
     group = self.groupObj
     if group:
-      toWrite = '<table border="1" width="100%">'
-      for user in group.users.getUsersSorted(lambda user: user.getName()):
-        name = user.getName()
-        #Add in their home address (or a default)
-        addressesRaw = [("Home", user.getAddress() or "No Home Address")]
-        #Add in all other addresses (if they have one. If not, getAddress returns false)
-        addressesRaw.extend([(type, user.getAddress(type)) for type in Events.ADDRESS_MODIFIERS if user.getAddress(type)])
-        maxLength = str(max(len("Home"), len(max(Events.ADDRESS_MODIFIERS, key = len)))) #Gets the length of the longest string (as a string) from address modifiers
-          #This part is just the html for where to insert the address and name
-        toWrite += '<tr><td class="AddressLeft">{}</td><td>{}</td></tr>'.format(user.getName(), \
-                   "<br>".join([("{:"+maxLength+"}: {}").format(data[0].title(), data[1]) for data in addressesRaw])) #This goes through each address, and adds the type (justified to max length), and then the address
-      toWrite += "</table>" #End HTML tag
+      toWrite = fragmentCache.get("addresses", group, lambda: self.makeAddresses(group))
     else:
       toWrite = "No group associated??? (Yell at Daniel)"
       
-    toSend = toSend.replace(self.STR_TITLE  , "Addresses")
-    toSend = toSend.replace(self.STR_CONTENT, toWrite)
-    
-    self.writeText(toSend)
+    self.loadTemplate(self.PAGE_DEF_GEN).render(self.writeBytes, title = "Addresses", content = toWrite)
     self.sendResponse()
     
+  #Makes the table of everyone's addresses for the addresses page
+  def makeAddresses(self, group):
+    toWrite = ['<table border="1" width="100%">']
+    maxLength = str(max(len("Home"), len(max(Events.ADDRESS_MODIFIERS, key = len)))) #Gets the length of the longest string (as a string) from address modifiers
+    for user in group.users.getUsersSorted(lambda user: user.getName()):
+      #Add in their home address (or a default)
+      addressesRaw = [("Home", user.getAddress() or "No Home Address")]
+      #Add in all other addresses (if they have one. If not, getAddress returns false)
+      for type in Events.ADDRESS_MODIFIERS:
+        address = user.getAddress(type)
+        if address:
+          addressesRaw.append((type, address))
+      #This part is just the html for where to insert the address and name
+      toWrite.append('<tr><td class="AddressLeft">{}</td><td>{}</td></tr>'.format(user.getName(), \
+                     "<br>".join([("{:"+maxLength+"}: {}").format(data[0].title(), data[1]) for data in addressesRaw]))) #This goes through each address, and adds the type (justified to max length), and then the address
+    toWrite.append("</table>") #End HTML tag
+    return "".join(toWrite)
+  
+  #Turns a message into a dict for the JSON api
+  def messageToJSON(self, searcher, index, message):
+    userName = message.getUserString()
+    if message.isUser():
+      user = searcher.group.users.getUserFromID(message.user_id)
+      if user:
+        userName = user.getName()
+    images = message.getAttachments("image") or []
+    return {"archive": searcher.group.groupID, "group": searcher.group.ID, "groupName": searcher.group.getName(), "index": index,
+            "id": message.get("id"), "userName": userName, "text": message.get("text"), "created_at": message.get("created_at"),
+            "avatar_url": message.get("avatar_url"), "images": [image['url'] for image in images], "likes": len(message.get("favorited_by") or [])}
+  
+  #JSON search api. Each request returns one page of results (oldest first)
+  #PARAM: query  - the search query
+  #       strict - "true" (default), "false" (search each word), or "regex"
+  #       scope  - "group" (default), "family", or "all". See getSearchers
+  #       limit  - number of results per page (default API_PAGE_SIZE, max API_MAX_PAGE_SIZE)
+  #       cursor - the "next" value from the previous page
+  #POST: Sends {"results": [...], "next": cursor or null}. Surrounding messages can be gotten from searchContext.json
+  API_PAGE_SIZE = 50
+  API_MAX_PAGE_SIZE = 200
+  @extSupport("json")
+  def do_searchApi(self):
+    if not self.groupObj:
+      return self.sendJSON({"error": self.ERR_NO_GRP}, http.client.BAD_REQUEST)
+    if 'query' not in self.params:
+      return self.sendJSON({"error": "No query found in search"}, http.client.BAD_REQUEST)
+    query = self.params["query"][0]
+    strict = self.params.get("strict", ("true",))[0]
+    try:
+      limit = min(max(int(self.params.get("limit", (self.API_PAGE_SIZE,))[0]), 1), self.API_MAX_PAGE_SIZE)
+      after = decodeCursor(self.params["cursor"][0]) if 'cursor' in self.params else None
+      #We get one extra result so we know if there is another page
+      results = list(MsgSearch.federatedSearch(self.getSearchers(), query, permissive = (strict == "false"), isRegex = (strict == "regex"), maxResults = limit+1, after = after))
+    except (ValueError, re.error, MsgSearch.SearchTimeout) as e: #re.error for bad regexes
+      return self.sendJSON({"error": str(e)}, http.client.BAD_REQUEST)
+      
+    nextCursor = encodeCursor(results[limit-1].getSortKey()) if len(results) > limit else None
+    self.sendJSON({"query": query, "next": nextCursor,
+                   "results": [self.messageToJSON(result.searcher, result.index, result.message) for result in results[:limit]]})
+    
+  #Gets the messages around a search result from the JSON api
+  #PARAM: archive - the "archive" of the result
+  #       index   - the "index" of the result
+  #       around  - number of messages on either side (default 2, max 25)
+  @extSupport("json")
+  def do_searchContext(self):
+    try:
+      archive = self.params["archive"][0]
+      index = int(self.params["index"][0])
+      around = min(max(int(self.params.get("around", (2,))[0]), 0), 25)
+    except (KeyError, ValueError):
+      return self.sendJSON({"error": "No archive/index sent or improper parameters"}, http.client.BAD_REQUEST)
+    #Only let people see archives they could have searched
+    for searcher in MsgSearch.getSearchersForGroups(securityGetGroups(self.userID)):
+      if searcher.group.groupID == archive:
+        return self.sendJSON({"messages": [self.messageToJSON(searcher, i, message) for i, message in searcher.getContext(index, around)]})
+    return self.sendJSON({"error": "No archive found for " + archive}, http.client.NOT_FOUND)
+    
+  #Sends each of the group's new messages as they come in, as Server-Sent Events. The connection stays open until the client leaves
+  #NOTE: This runs without the message processing lock, so it only reads from its LiveFeed.Subscriber
+  @extSupport("")
+  @noLock
+  def do_liveFeed(self):
+    if not self.groupObj:
+      return self.sendError(self.ERR_NO_GRP)
+    subscriber = LiveFeed.subscribe(self.group)
+    try:
+      self.handler.connection.settimeout(None) #The feed stays open much longer than an idle keep-alive connection would
+      self.startStream(headers = {"Content-Type": "text/event-stream; charset=" + self.ENCODING, "Cache-Control": "no-cache"})
+      self.writeText("retry: 5000\n\n") #How long the browser should wait before reconnecting
+      self.flushStream()
+      while True:
+        messages = subscriber.get(LiveFeed.HEARTBEAT)
+        if messages is None: #We fell behind or the server is closing. The browser will reconnect
+          break
+        if not messages:
+          self.writeText(": keep-alive\n\n") #Comments are ignored by the browser, but stop the connection from looking dead
+        for eventID, data in messages:
+          self.writeText("id: {}\ndata: {}\n\n".format(eventID, data))
+        self.flushStream()
+      self.endStream()
+    except OSError: #The browser left (ConnectionError), or the connection timed out
+      log.web.debug("Live feed closed by client")
+      self.handler.close_connection = True
+    finally:
+      LiveFeed.unsubscribe(subscriber)
+      
   @extSupport("")
   def do_getLog(self):
     fileName = Files.getLog()
     log.web.debug("Redirecting to log file:",fileName)
     self.redirectFile("/"+fileName)
+    
+  #Sends the end of a log file, reading only as much of the file as it needs
+  #PARAM: lines - number of lines to send (default 100, max TAIL_MAX_LINES)
+  #       log   - which log file, like Files.getLog (default -1, the newest)
+  TAIL_MAX_LINES = 10000
+  @extSupport("", "txt")
+  def do_tailLog(self):
+    try:
+      numLines = min(int(self.params.get("lines", (100,))[0]), self.TAIL_MAX_LINES)
+      logNum = int(self.params.get("log", (-1,))[0])
+    except ValueError:
+      return self.sendError("Improper parameters")
+    try:
+      self.writeBytes(Files.tailFile(Files.getLog(logNum), numLines))
+    except FileNotFoundError:
+      return self.sendFile(self.PAGE_NO_PATH, code = http.client.NOT_FOUND)
+    self.sendResponse(headers = {"Content-Type": "text/plain; charset=" + self.ENCODING, "Cache-Control": "no-cache"})
   
+  SEARCH_MAX_RESULTS = 250
   def do_searchResults(self):
     log.web.debug("Starting search results")
-    toSend = self.loadFile(self.PAGE_DEF_GEN)
     group = self.groupObj
     if group:
-      numFound = 0
-      maxResults = 250
-      numAround  = 2 #Number on either side of found
-      nameLimit = 20 #Characters for a group name
-      #We are going to be yielding data so we do not need to buffer
-      
       if 'query' in self.params:
-      
         query = self.params["query"][0]
-        permissiveSearch = "strict" in self.params and (self.params["strict"][0] == "false")
         log.web("Starting search results for query: ",query)
+        strict = self.params.get("strict", ("true",))[0]
+        order = self.params.get("order", ("time",))[0]
+        #Search before sending anything, so a bad search can still get an error page
+        try:
+          results = MsgSearch.federatedSearch(self.getSearchers(), query, permissive = (strict == "false"), order = order,
+                                              maxResults = self.SEARCH_MAX_RESULTS+1, isRegex = (strict == "regex"))
+        except (ValueError, re.error, MsgSearch.SearchTimeout) as e: #re.error for bad regexes
+          log.web("Search for", repr(query), "failed:", e)
+          self.loadTemplate(self.PAGE_DEF_GEN).render(self.writeBytes, title = "Search Results",
+            content = '<form action="search.html"><button style="display:inline-block;width:100%;">Do another search!</button></form>' +
+                      "<p>Could not search for " + html.escape(query) + ": " + html.escape(str(e)) + "</p>")
+          return self.sendResponse(http.client.BAD_REQUEST)
+        #We are going to be streaming data as results are gone through so we do not need to buffer
+        self.startStream()
+        self.loadTemplate(self.PAGE_DEF_GEN).render(self.writeBytes, title = "Search Results", content = lambda: self.writeSearchResults(query, results))
+        self.endStream() #Then send the rest of the data
+      else:
+        self.sendError("No query found in search!")
+        raise RuntimeError("No query in search") #Gets picked up to send error
         
-        #This will be copied and modified by every search result
-        mainMessage = """<tr class="SearchContainer {subclass}" id="{resultNum}{position}">
-          <td class="SearchLeft"><div style="text-align:center;padding=0px;margin=px">{userName}</div>{groupName}<br>{date}</td>
-          <td class="SearchPicture"><a href="searchResults.html?query={text}&strict=true"><img class = "SearchPicture" src="{avatar}"></a></td>
+  #This will be copied and modified by every search result
+  SEARCH_RESULT = Templates.Template("""<tr class="SearchContainer %subclass%" id="%resultNum%%position%">
+          <td class="SearchLeft"><div style="text-align:center;padding=0px;margin=px">%userName%</div>%groupName%<br>%date%</td>
+          <td class="SearchPicture"><a href="searchResults.html?query=%text%&strict=true"><img class = "SearchPicture" src="%avatar%"></a></td>
           <td class="SearchRight"><div class="SearchResults">
-            {text}
-            {image}
+            %text%
+            %image%
             </div></td>
-        </tr>\n"""
+        </tr>\n""")
+  SEARCH_PICTURE = """<br><img width=75% style="padding-top:10px" src="{}">"""
         
-        pictureText = """<br><img width=75% style="padding-top:10px" src="{}">"""
-
-        #Send top part of html
-        self.writeText(toSend.split(self.STR_CONTENT)[0].replace(self.STR_TITLE, "Search Results"))
-        
-        #Write initial scripts
-        self.writeText('''<script src="util.js"></script>
-                          <script src="searchClickScript.js"></script>
-                          <form action="search.html"><button style="display:inline-block;width:100%;">Do another search!</button></form>
-                          <p>Your Search: {query}</p><br>
-                          <table border="5" width="100%" sytle="table-layout:fixed">'''.format(query = query))
-        i=-1
-        searcher = MsgSearch.getSearcher(group)
-        for message in searcher:
-          i += 1
-          #Iterates through all words of prompt if permissive, otherwise through a tuple containing only the query
-          for word in (re.split("\W+", query) if permissiveSearch else (query,)):
-            #Searches for the word(s) in each message (text can be None)
-            if message.text and re.search(re.escape(word), message.text, re.IGNORECASE):
-              #And the message and surrounding ones
-              #This directly sends each search result as its generated
-              lowerBound = max(i-numAround, 0)
-              upperBound = min(i+numAround+1, len(searcher)-1)
-              index = lowerBound #Index starts at this bound, and increases to upperBound-1
-              for message in searcher[lowerBound : upperBound]:
-              
-                #Get user's name (or system) for display
-                userName = message.getUserString()
-                if message.isUser():
-                  user = group.users.getUserFromID(message.user_id)
-                  if user:
-                    userName = user.getName()
-                    
-                #Just directly writes this part as soon as its done
-                self.writeText(mainMessage.format(\
-                  #Only the main result should be visible
-                  subclass = ("" if index == i else "Hidden"), \
-                  #The result number on the page
-                  resultNum = str(numFound), \
-                  #If not the initial value, sets the index to the difference in index and lower bound, then subtracts another if it is after the intitial value
-                  position = ("" if index == i else (" "+str(index-lowerBound-int(index >= i)))), \
-                  #User's name or "calendar" or "system" or whatever
-                  userName  = userName, 
-                  #The group's name (shortened)
-                  groupName = (group.getName()[:nameLimit] + ("..." if len(group.getName()) >= nameLimit else "")), 
-                  #Add date message was sent
-                  date = datetime.date.fromtimestamp(int(message["created_at"])).strftime("%m/%d/%y"), \
-                  #The user's avatar url (if none it will put the icon of it)
-                  avatar = (message['avatar_url'] or self.PAGE_ICON), \
-                  #The actual message text
-                  text = (message['text'] or "").replace("\n","<br>"), \
-                  #The optional image (if there is one)
-                  image = (pictureText.format(message['attachments'][0]['url']) if (len(message['attachments']) > 0 and message['attachments'][0]['type'] == "image") else "") \
-                  ))
-                index += 1 #Increment index
-              
-              numFound += 1 #Add that we have found another matched
-              break #Don't want to generate multiple results from the same message
-          if numFound > maxResults: #So people don't break the server
-            break
-        
-        self.writeText("</table>")
-        if numFound == 0:
-          self.writeText("No messages matched your search")
-        if numFound > maxResults:
-          self.writeText("Too Many Results...")
-          
-        #Send bottom part of html
-        self.writeText(toSend.split(self.STR_CONTENT, 1)[1]) #Split with max split size of 1
-        
-        self.sendResponse() #Then send all the data
-      else:
-        self.sendError("No query found in search!")
-        raise RuntimeError("No query in search") #Gets picked up to send error
+  #Writes the content of the search results page
+  #PRE : results is the iterable of SearchResults from MsgSearch.federatedSearch
+  def writeSearchResults(self, query, results):
+    numFound = 0
+    maxResults = self.SEARCH_MAX_RESULTS
+    numAround  = 2 #Number on either side of found
+    nameLimit = 20 #Characters for a group name
+    
+    #Write initial scripts
+    self.writeText('''<script src="util.js"></script>
+                      <script src="searchClickScript.js"></script>
+                      <form action="search.html"><button style="display:inline-block;width:100%;">Do another search!</button></form>
+                      <p>Your Search: {query}</p><br>
+                      <table border="5" width="100%" sytle="table-layout:fixed">'''.format(query = query))
+    for result in results:
+      i = result.index
+      resultGroup = result.searcher.group
+      #The group's name (shortened)
+      groupName = resultGroup.getName()[:nameLimit] + ("..." if len(resultGroup.getName()) >= nameLimit else "")
+      #Get the message and surrounding ones
+      #This directly sends each search result as its generated
+      lowerBound = max(i-numAround, 0)
+      for index, message in result.getContext(numAround):
+      
+        #Get user's name (or system) for display
+        userName = message.getUserString()
+        if message.isUser():
+          user = resultGroup.users.getUserFromID(message.user_id)
+          if user:
+            userName = user.getName()
+            
+        #Just directly writes this part as soon as its done
+        self.SEARCH_RESULT.render(self.writeBytes,
+          #Only the main result should be visible
+          subclass = ("" if index == i else "Hidden"),
+          #The result number on the page
+          resultNum = str(numFound),
+          #If not the initial value, sets the index to the difference in index and lower bound, then subtracts another if it is after the intitial value
+          position = ("" if index == i else (" "+str(index-lowerBound-int(index >= i)))),
+          #User's name or "calendar" or "system" or whatever
+          userName  = userName,
+          groupName = groupName,
+          #Add date message was sent
+          date = datetime.date.fromtimestamp(int(message["created_at"])).strftime("%m/%d/%y"),
+          #The user's avatar url (if none it will put the icon of it)
+          avatar = (message['avatar_url'] or self.PAGE_ICON),
+          #The actual message text
+          text = (message['text'] or "").replace("\n","<br>"),
+          #The optional image (if there is one)
+          image = (self.SEARCH_PICTURE.format(message['attachments'][0]['url']) if (len(message['attachments']) > 0 and message['attachments'][0]['type'] == "image") else "")
+          )
+      
+      numFound += 1 #Add that we have found another matched
+      if numFound > maxResults: #So people don't break the server
+        break
+    
+    self.writeText("</table>")
+    if numFound == 0:
+      self.writeText("No messages matched your search")
+    if numFound > maxResults:
+      self.writeText("Too Many Results...")
   
   def do_selectionScreen(self):
     log.web.debug("Sending Selection Screen")
-    basicFile = self.loadFile(self.fileName)
+    content = fragmentCache.get("selectionScreen", None, self.makeSelectionScreen)
+    self.loadTemplate(self.fileName).render(self.writeBytes, content = content)
+    self.sendResponse() #Send good response
     
+  #Makes the list of all groups for the selection screen
+  def makeSelectionScreen(self):
     content = ""
     for group in Groups.getSortedList(groupType = Groups.MainGroup): #Get a list of all the main groups
       if group.getID() != 99: #If is not error group
@@ -538,11 +1124,7 @@ class GetHandler(Handler):
           <td valign="middle" style="text-align:center"><p style="font-size:110%;margin:5pt">{groupName}</p><p style="font-size:100%;font-style:italic;color:#008800;margin:5pt">Group {group}</p></td>
           <td width = 1pt><img src="{groupImage}" style="vertical-align:middle;width:90px"></td>
         </tr>""".format(group = group.getID(), groupName = group.getName(), groupImage = group.image or self.PAGE_ICON))
-      
-    basicFile = basicFile.replace(self.STR_CONTENT, content)
-    
-    self.writeText(basicFile)
-    self.sendResponse() #Send good response
+    return content
     
   @extSupport("")
   def do_shutdownserver(self):
@@ -553,6 +1135,23 @@ class GetHandler(Handler):
     else:
       return self.sendFile("noAuth.html", http.client.FORBIDDEN)
           
+  #All the server's metrics, in the Prometheus text format
+  #NOTE: This runs without the message processing lock, so scrapes aren't held up by slow searches. Metrics have their own locks
+  @extSupport("")
+  @noLock
+  def do_metrics(self):
+    self.writeText(Metrics.expose())
+    self.sendResponse(headers = {"Content-Type": "text/plain; version=0.0.4; charset=" + self.ENCODING, "Cache-Control": "no-cache"})
+    
+  #Shows how many times each generated page has been requested and how long they took
+  @extSupport("json")
+  def do_routeStats(self):
+    if getCookie(self.cookies, "administrator"): #Here be admin access
+      return self.sendJSON({"requestsProcessed": Handler.requestsProcessed,
+                            "GET": GetHandler.router.getStats(), "POST": PostHandler.router.getStats()})
+    else:
+      return self.sendFile("noAuth.html", http.client.FORBIDDEN)
+      
   @extSupport("")
   def do_restartserver(self):
     if getCookie(self.cookies, "administrator"): #Here be admin access
@@ -566,16 +1165,18 @@ class GetHandler(Handler):
     group = self.groupObj
     if not group:
       return self.sendError(self.ERR_NO_GRP)
-    file = self.loadFile(self.fileName)
+    names = fragmentCache.get("users", group, lambda: self.makeUserOptions(group))
+    self.loadTemplate(self.fileName).render(self.writeBytes, content = names)
+    self.sendResponse()
+    
+  #Makes the list of users to pick from on the users page
+  def makeUserOptions(self, group):
     names = "<option value=''>[None]</option>\n"
     #Note: True is for "preferGroupMe"
     nextUser = lambda user: "<option value='{}'>{}</option>\n".format(user.ID, user.getName(True))
     for user in group.users.getUsersSorted(lambda user: user.getName(True)):
       names += nextUser(user)
-    file = file.replace(self.STR_CONTENT, names, 1)
-    
-    self.writeText(file)
-    self.sendResponse()
+    return names
   
   #This should be called from the users page only
   #in mode 'get' will return html for viewing the users names
@@ -647,4 +1248,15 @@ class GetHandler(Handler):
         toSend+= "success" if user.addAlias(name) else "failure"
     
     self.writeText(toSend)
-    self.sendResponse()
\ No newline at end of file
+    self.sendResponse()
+    
+#POST: Returns False if the request is for a page that should not hold the message processing lock
+def needsLock(method, path):
+  router = PostHandler.router if method == "POST" else GetHandler.router
+  route = router.get(parsePath(path.partition("?")[0])[1])
+  return not route or route.useLock
+  
+### ROUTES ###
+#Built once here so each request only has to look up its page
+PostHandler.router = Router(PostHandler)
+GetHandler.router  = Router(GetHandler)
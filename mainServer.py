@@ -22,13 +22,17 @@ import http.server
 import socketserver #For the threading mixin
 import traceback
 from datetime import time, timedelta
+from time import perf_counter
 
 #My Imports
 import Commands
 import Events
 import Files
 import Jokes
+import LiveFeed
 import Logging as log
+import Metrics
+import MsgSearch
 import Network
 import Groups
 import Users
@@ -36,6 +40,12 @@ import Website
 
 #Globals
 SEND_ERRORS_OVER_GROUPME = not Events.IS_TESTING
+KEEP_ALIVE_TIMEOUT = 15 #Seconds a browser's connection can sit idle before we close it
+
+#Metrics
+ACK_LATENCY = Metrics.histogram("callback_ack_seconds", "Time from getting a GroupMe callback to acknowledging it", ["group"])
+HANDLE_TIME = Metrics.histogram("handle_message_seconds", "Time taken to handle a GroupMe message", ["group"])
+LOCK_WAIT   = Metrics.histogram("lock_wait_seconds", "Time requests waited for the message processing lock")
 
 class ServerStopError(Exception): #Just to let us know what has been done in messages
   def getValue(self):
@@ -45,15 +55,15 @@ class ServerStopError(Exception): #Just to let us know what has been done in mes
       return True
 
 #This is mostly the same, but I want custom error logging
-class Server(http.server.HTTPServer): 
+#Each connection gets its own thread, so a browser keeping its connection open doesn't stop anyone else from being answered
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer): 
+  daemon_threads = True #Idle connections shouldn't keep the server from closing
 
   def __init__(self, *arg, **kwarg):
     super().__init__(*arg, **kwarg)
     self.exitValue = None #Defaults to not set
 
   def handle_error(self, request, client_address):
-    Events.getLockObject().release() #Release the lock we have on message processing
-    
     stringBuffer = io.StringIO()
     traceback.print_exc(file = stringBuffer)
     stringBuffer.seek(0) #Reset to start of message
@@ -80,43 +90,69 @@ class Server(http.server.HTTPServer):
         raise e #Jk I do
 
   def finish_request(self, request, client_address):
+    try:
+      super().finish_request(request, client_address) #Actually processes the messages on this connection
+    except ConnectionAbortedError:
+      log.net.debug("Of note: Connection Aborted")
+      
+  #Processes a single request. A connection can send many requests, so the lock is held for each request rather than the whole connection
+  #PRE : function is the function that handles the request
+  #      if useLock is False, the request is processed without the lock (for pages that stay open, like live feeds)
+  def processLocked(self, function, *arg, useLock = True):
     #Sets a lock object for the server. Updating groups/data in another thread will lock the server from responding to a request
-    lock = Events.getLockObject()
+    lock = Events.getLockObject() if useLock else None
     if lock:
       print("Acquiring lock for message processing") #Honestly I don't want to log this, but if I come look at the screen I would want to see this
-      lock.acquire()
+      with LOCK_WAIT.time():
+        lock.acquire()
       print("Acquired lock")
       
     try:
-      super().finish_request(request, client_address) #Actually processes the message
-    except ConnectionAbortedError:
-      log.net.debug("Of note: Connection Aborted")
-    
-    if not Events.NonBlockingShutdownLock.acquire(blocking = False):
-      self.exitValue = False
-      log.info.debug("Request indicates shutdown. Shutting down server")
-      Events.quickDaemonThread(self.shutdown) #Because shutdown does a "wait" for the current request to end and causes deadlock
-    Events.NonBlockingShutdownLock.release() #Release once checked
-    
-    if not Events.NonBlockingRestartLock.acquire(blocking = False):
-      self.exitValue = True
-      log.info.debug("Request indicates restart. Shutting down server")
-      Events.quickDaemonThread(self.shutdown) #Because shutdown does a "wait" for the current request to end and causes deadlock
-    Events.NonBlockingRestartLock.release() #Release once checked
-    
-    
-    if lock:
-      lock.release()
+      return function(*arg)
+    finally:
+      if lock: #Shutdown and restart are only asked for while holding the lock, so only check while we have it
+        self.checkForShutdown()
+        lock.release()
+        
+  #Shuts down the server if a request has asked for it
+  #PRE : The message lock is held, so no other request is checking or setting the signals
+  def checkForShutdown(self):
+    for signal, exitValue, action in [(Events.NonBlockingShutdownLock, False, "shutdown"), (Events.NonBlockingRestartLock, True, "restart")]:
+      if signal.acquire(blocking = False):
+        signal.release() #Nobody asked. Undo our own acquire
+      else:
+        self.exitValue = exitValue
+        log.info.debug("Request indicates " + action + ". Shutting down server")
+        Events.quickDaemonThread(self.shutdown) #Because shutdown does a "wait" for the current request to end and causes deadlock
+        signal.release() #Clear the request now that it has been handled, so the next server doesn't see it
     
 
-class ServerHandler(socketserver.ThreadingMixIn, http.server.BaseHTTPRequestHandler):
+class ServerHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1" #So browsers can load a page and all its files over one connection
+  timeout = KEEP_ALIVE_TIMEOUT
+  
   def getContent(self):
     try:
       return self.rfile.read(int(self.headers.get('Content-Length'))).decode("UTF-8")
     except TypeError:
+      self.close_connection = True #Without a length, the body only ends when the connection does
       return self.rfile.read().decode("UTF-8")
+      
+  #Keeps track of whether a response has been started, so errors don't send a second one
+  def send_response(self, *arg, **kwarg):
+    self.responseStarted = True
+    super().send_response(*arg, **kwarg)
+    
+  def do_POST(self):
+    self.responseStarted = False
+    self.receivedAt = perf_counter() #For acknowledgement latency
+    self.server.processLocked(self.processPOST)
+    
+  def do_GET(self):
+    self.responseStarted = False
+    self.server.processLocked(self.processGET, useLock = Website.needsLock("GET", self.path))
 
-  def do_POST(self, messageOverride = None): #For GroupMe messages and server passwords
+  def processPOST(self, messageOverride = None): #For GroupMe messages and server passwords
     if messageOverride:
       #Allow us to test without stealing the other server
       messageBody = messageOverride
@@ -135,7 +171,9 @@ class ServerHandler(socketserver.ThreadingMixIn, http.server.BaseHTTPRequestHand
       ### Note: The way to implement headers is "send_response, send_header, send_header..., end_headers"
       ### Also: For writing body, just use self.wfile.write after end headers
       self.send_response(200) #Reply that we have received the message. No further response is needed
+      self.send_header("Content-Length", "0")
       self.end_headers()
+      ackTime = perf_counter() - getattr(self, "receivedAt", perf_counter())
       
       log.network.debug("Message received:", message)
       message = Commands.Message(message) #Give us all our nice functions
@@ -147,18 +185,24 @@ class ServerHandler(socketserver.ThreadingMixIn, http.server.BaseHTTPRequestHand
       else: #There is a group in the message
         if workingGroup: #If the group exists
           log.info.debug("Handling message for Group",workingGroup.ID)
-          workingGroup.handleMessage(message) #Yes, let us pass all the hard work to the helper files
+          ACK_LATENCY.observe(ackTime, group = workingGroup.ID)
+          with HANDLE_TIME.time(group = workingGroup.ID):
+            workingGroup.handleMessage(message) #Yes, let us pass all the hard work to the helper files
         else:
           log.info.error("No group found associated with",message.group_id)
   
 
-  def do_GET(self): #For web requests
+  def processGET(self): #For web requests
     log.info.debug("Received a normal http GET message")
     try:
       Website.handleRequest("GET", self) #Give web request with the message and headers
     except Exception as e:
-      self.send_response(500) #Internal server error
-      self.end_headers()
+      if self.responseStarted: #Part of a response has been sent, so it can't be finished properly. Drop the connection instead
+        self.close_connection = True
+      else:
+        self.send_response(500) #Internal server error
+        self.send_header("Content-Length", "0")
+        self.end_headers()
       raise e #And GTFO
   
   #Log who the request was from
@@ -304,6 +348,7 @@ def main():
     updaterWebsite    = Events.DailyUpdater( time(4,58), Website.securityPurge) #Just do this seperately
     earlyMorningFacts = Events.DailyUpdater( time(3, 0), postEarlyMorningFact)
     monthlyMsgRefresh = Events.WeeklyUpdater(time(5,10), Events.WEEKDAY.SATURDAY, updateAllMsgLists, unitDifference = 4) #Once a month
+    dailyLikeRefresh  = Events.DailyUpdater( time(5,20), MsgSearch.refreshAllLikes)
     dailyCivReminder  = Events.DailyUpdater( time(15,0), postCivReminder)
     
     log.info("========== BEGINNING SERVER RECEIVING ==========")
@@ -344,7 +389,10 @@ def main():
   #We need to kill all threads before exiting
   finally:
     Events.stopAllTimers()
+    Events.shutdownWorkerPool()
     Events.SyncSave().saveAll(final = True)
+    MsgSearch.shutdownProcessPool()
+    LiveFeed.closeAll()
   
     
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+#Run from the main folder with "python -m unittest discover tests"
+import os, sys, tempfile, types, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp()) #Importing makes log files in the current folder
+import mainServer #Other modules must be imported through mainServer first, because they import each other
+import Users
+
+def makeUser(ID, GMName, realName = None, alias = ()):
+  return types.SimpleNamespace(ID = ID, GMName = GMName, realName = realName, alias = list(alias))
+
+class TestTrigramIndex(unittest.TestCase):
+  def setUp(self):
+    self.zoe   = makeUser("1", "Zoe")
+    self.isaac = makeUser("2", "Isaac Newton", alias = ["Ike"])
+    self.index = Users.TrigramIndex([self.zoe, self.isaac])
+    
+  def test_typoInSentence(self):
+    #From "@botsly what is Zoee's college address", the name is only one word of the recipient
+    self.assertIs(self.index.find("is Zoee colle"), self.zoe)
+    self.assertIs(self.index.find("@botsly what is Zoee's college address"), self.zoe)
+    
+  def test_wholeName(self):
+    self.assertIs(self.index.find("Isaac Newtn"), self.isaac)
+    
+  def test_shortWordsDontMatch(self):
+    self.assertIsNone(self.index.find("what is it"))
+    
+if __name__ == "__main__":
+  unittest.main()